@@ -32,12 +32,13 @@ def get_spiking_proj_gids(config, sim_config, circuit_config):
     spiking_pattern_gids = {}
     for node_pop, spikes in proj_spikes.items():
         if node_pop == list(config.patterns_edges.keys())[0]:
-            spiking_gids = spikes["spiking_gids"]
+            # (unique gids are found once, instead of masking all spikes for every pattern)
+            spiking_gids = np.unique(spikes["spiking_gids"])
             for pattern_name, gids in pattern_gids.items():
-                spiking_pattern_gids[pattern_name] = np.unique(spiking_gids[np.in1d(spiking_gids, gids)])
+                spiking_pattern_gids[pattern_name] = spiking_gids[np.in1d(spiking_gids, gids)]
         else:
             ns_gids = np.unique(spikes["spiking_gids"])
-    return {patterns_edge_pop: np.unique(spiking_gids), ns_edge_pop: ns_gids}, spiking_pattern_gids
+    return {patterns_edge_pop: spiking_gids, ns_edge_pop: ns_gids}, spiking_pattern_gids
 
 
 def get_proj_innervation(config):
@@ -6,6 +6,7 @@ last modified: 10.2022
 
 import os
 import numpy as np
+from scipy.sparse import csr_matrix
 from scipy.stats import binom, pearsonr, hypergeom
 
 
@@ -44,6 +45,13 @@ def __initialize_h5__(filename, version=None, assert_exists=False):
     return version
 
 
+def __h5_version__(h5):
+    """Gets IO version from an already open HDF5 file (or group in it)"""
+    version = h5.file.attrs.get(__str_io_version__, __io_version__)
+    assert version in __h5_writers__, "Unknown version: {0}".format(version)
+    return version
+
+
 def __to_h5_1p0__(data, h5, prefix=None):
     strings = __h5_strings__["1.0"]
     if prefix is None:
@@ -66,19 +74,21 @@ def __to_h5_1p0__(data, h5, prefix=None):
     return prefix
 
 
-def __from_h5_1p0__(h5, group_name, prefix=None):
+def __from_h5_1p0__(h5, group_name, prefix=None, all_neurons=None):
+    from assemblyfire.utils import _read_h5_dset
     strings = __h5_strings__["1.0"]
     if prefix is None:
         prefix = strings["assembly_group"]
 
     prefix_grp = h5[prefix]
-    assert group_name in prefix_grp.keys()
-    all_neurons = np.unique(np.hstack([prefix_grp[k][strings["gids"]][:]
-                                       for k in prefix_grp.keys()
-                                       if k not in __RESERVED__]))
-
-    R = prefix_grp[group_name][strings["gids"]][:]
-    M = prefix_grp[group_name][strings["bool_index"]][:]
+    assert group_name in prefix_grp
+    if all_neurons is None:  # (union of the gids of all groups under `prefix`, which can be passed to avoid rereading)
+        all_neurons = np.unique(np.hstack([_read_h5_dset(prefix_grp[k][strings["gids"]])
+                                           for k in prefix_grp.keys()
+                                           if k not in __RESERVED__]))
+
+    R = _read_h5_dset(prefix_grp[group_name][strings["gids"]])
+    M = _read_h5_dset(prefix_grp[group_name][strings["bool_index"]])
     metadata = dict(prefix_grp[group_name].attrs)
     orig_indices = metadata.get(strings["indices"], list(range(M.shape[1])))
 
@@ -225,26 +235,27 @@ class Assembly(object):
         :param seed: if specified, sets the random seed
         :return: An Assembly object containing a randomly subsampled set of gids
         """
-        if seed is not None:
-            np.random.seed(seed)
+        rng = np.random.default_rng(seed)
         if isinstance(subsample_at, int):
             N = subsample_at
         elif isinstance(subsample_at, float):
             N = int(len(self) * subsample_at)
-        return Assembly(np.random.choice(self.gids, N, replace=False), index=self.idx)
+        return Assembly(rng.choice(self.gids, N, replace=False, shuffle=False), index=self.idx)
 
     @staticmethod
     def random_numerical_gids(nrn, num_var, ref_gids, n_bins, seed):
         """Quick and dirty reimplementation of conntility's MatrixNodeIndexer functionality"""
         hist, bin_edges = np.histogram(nrn.loc[nrn["gid"].isin(ref_gids), num_var].to_numpy(), n_bins)
         bin_idx = np.digitize(nrn[num_var].to_numpy(), bin_edges)
-        all_gids, sample_gids = nrn["gid"].to_numpy(), []
+        order = np.argsort(bin_idx, kind="stable")  # gids grouped by bins (instead of `np.where()` for every bin)
+        starts = np.searchsorted(bin_idx[order], np.arange(1, n_bins + 2))
+        all_gids = nrn["gid"].to_numpy()[order]
+        sample_gids, offsets = np.empty(hist.sum(), dtype=all_gids.dtype), np.concatenate([[0], np.cumsum(hist)])
+        rng = np.random.default_rng(seed)
         for i in range(n_bins):
-            if seed is not None:
-                np.random.seed(seed)
-            idx = np.where(bin_idx == i + 1)[0]
-            sample_gids.extend(np.random.choice(all_gids[idx], hist[i], replace=False).tolist())
-        return np.array(sample_gids)
+            sample_gids[offsets[i]:offsets[i+1]] = rng.choice(all_gids[starts[i]:starts[i+1]], hist[i],
+                                                              replace=False, shuffle=False)
+        return sample_gids
 
     def random_numerical_control(self, nrn, num_var, n_bins=50, seed=None):
         """
@@ -256,20 +267,24 @@ class Assembly(object):
         :param seed: if specified, sets the random seed
         :return: An Assembly object containing a randomly sampled set of gids
         """
-        assert np.in1d(self.gids, nrn["gid"].to_numpy(), assume_unique=True).all(), "Not all assembly gids are part" \
-                                                                                    "of the DataFrame passed"
+        assert nrn["gid"].isin(self.gids).sum() == len(self.gids), "Not all assembly gids are part" \
+                                                                   "of the DataFrame passed"
         return Assembly(self.random_numerical_gids(nrn, num_var, self.gids, n_bins, seed), index=self.idx)
 
     @staticmethod
     def random_categorical_gids(nrn, cat_var, ref_gids, seed):
         """Quick and dirty reimplementation of conntility's MatrixNodeIndexer functionality"""
+        all_values, cat_idx = np.unique(nrn[cat_var].to_numpy(), return_inverse=True)
         values, counts = np.unique(nrn.loc[nrn["gid"].isin(ref_gids), cat_var].to_numpy(), return_counts=True)
-        all_gids, cat_vals, sample_gids = nrn["gid"].to_numpy(), nrn[cat_var].to_numpy(), []
-        for value, count in zip(values, counts):
-            if seed is not None:
-                np.random.seed(seed)
-            sample_gids.extend(np.random.choice(all_gids[cat_vals == value], count, replace=False).tolist())
-        return np.array(sample_gids)
+        order = np.argsort(cat_idx, kind="stable")  # gids grouped by categories (instead of masking for every value)
+        starts = np.searchsorted(cat_idx[order], np.arange(len(all_values) + 1))
+        all_gids, value_idx = nrn["gid"].to_numpy()[order], np.searchsorted(all_values, values)
+        sample_gids, offsets = np.empty(counts.sum(), dtype=all_gids.dtype), np.concatenate([[0], np.cumsum(counts)])
+        rng = np.random.default_rng(seed)
+        for i, j in enumerate(value_idx):
+            sample_gids[offsets[i]:offsets[i+1]] = rng.choice(all_gids[starts[j]:starts[j+1]], counts[i],
+                                                              replace=False, shuffle=False)
+        return sample_gids
 
     def random_categorical_control(self, nrn, cat_var, seed=None):
         """
@@ -280,8 +295,8 @@ class Assembly(object):
         :param seed: if specified, sets the random seed
         :return: An Assembly object containing a randomly sampled set of gids
         """
-        assert np.in1d(self.gids, nrn["gid"].to_numpy(), assume_unique=True).all(), "Not all assembly gids are part" \
-                                                                                    "of the DataFrame passed"
+        assert nrn["gid"].isin(self.gids).sum() == len(self.gids), "Not all assembly gids are part" \
+                                                                   "of the DataFrame passed"
         return Assembly(self.random_categorical_gids(nrn, cat_var, self.gids, seed), index=self.idx)
 
 
@@ -307,6 +322,7 @@ class AssemblyGroup(object):
             self.metadata = {}
         else:
             self.metadata = metadata
+        self._membership_cache = {}
 
     def __iter__(self):
         """Returns an iterator over contained Assemblies"""
@@ -361,6 +377,27 @@ class AssemblyGroup(object):
             return np.in1d(self.all, assembly.gids)
         return np.vstack([self.as_bool(iloc=i) for i in range(len(self))]).transpose()
 
+    def as_sparse(self, gids=None):
+        """
+        Returns a sparse bool matrix where an entry is true if a neuron from `gids` is contained in an assembly.
+        (Built with a single lookup of all assembly gids and cached, as it's reused for the same gids over and over.)
+        :param gids: (optional) gids to check (e.g. all gids of a connectivity matrix), if not provided self.all is used
+        :return: scipy.sparse.csr_matrix with assemblies as rows and `gids` as columns
+        """
+        gids = self.all if gids is None else np.asarray(gids)
+        key = gids.tobytes()
+        if key not in self._membership_cache:
+            asm_gids = np.concatenate([assembly.gids for assembly in self])
+            asm_idx = np.repeat(np.arange(len(self)), [len(assembly.gids) for assembly in self])
+            sort_idx = np.argsort(gids, kind="stable")
+            pos = np.searchsorted(gids, asm_gids, sorter=sort_idx)
+            valid = pos < len(gids)
+            valid[valid] = gids[sort_idx[pos[valid]]] == asm_gids[valid]
+            self._membership_cache[key] = csr_matrix((np.ones(valid.sum(), dtype=bool),
+                                                      (asm_idx[valid], sort_idx[pos[valid]])),
+                                                     shape=(len(self), len(gids)))
+        return self._membership_cache[key]
+
     def loc(self, idx):
         matches = [assembly for assembly in self if assembly.idx == idx]
         if len(matches) == 0:
@@ -430,11 +467,17 @@ class AssemblyGroup(object):
             return write_func(self, h5, prefix)
 
     @classmethod
-    def from_h5(cls, fn, group_name, prefix=None):
+    def from_h5(cls, fn, group_name, prefix=None, all_neurons=None):
+        """Reads object from HDF5 file. `fn` is either the path of the file,
+        or an already open `h5py.File` (or group), so that the file isn't reopened for every group read.
+        `all_neurons` (the union of gids of all groups in `prefix`) can be passed when reading several groups
+        from the same file, so that the gids of all groups aren't reread for every group"""
         import h5py
+        if isinstance(fn, h5py.Group):
+            return cls.h5_read_func[__h5_version__(fn)](fn, group_name, prefix=prefix, all_neurons=all_neurons)
         read_func = cls.h5_read_func[__initialize_h5__(fn, assert_exists=True)]
         with h5py.File(fn, "r") as h5:
-            return read_func(h5, group_name, prefix=prefix)
+            return read_func(h5, group_name, prefix=prefix, all_neurons=all_neurons)
 
     def aligned_intersections(self, other=None):
         """
@@ -530,7 +573,11 @@ class ConsensusAssembly(Assembly):
 
     @classmethod
     def from_h5(cls, fn, group_name, prefix=None):
+        """Reads object from HDF5 file. `fn` is either the path of the file,
+        or an already open `h5py.File` (or group), so that the file isn't reopened for every group read"""
         import h5py
+        if isinstance(fn, h5py.Group):
+            return cls.h5_read_func[__h5_version__(fn)](fn, group_name, prefix=prefix)
         read_func = cls.h5_read_func[__initialize_h5__(fn, assert_exists=True)]
         with h5py.File(fn, "r") as h5:
             return read_func(h5, group_name, prefix=prefix)
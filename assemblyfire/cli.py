@@ -68,10 +68,11 @@ def syn_clust(config_path, debug):
 @click.argument("assembly_grp_name", required=True)
 @click.argument("buf_size", required=False, default=100)
 @click.argument("seed", required=False, default=100)
-def syn_nnd(config_path, assembly_grp_name, buf_size, seed):
+@click.argument("n_workers", required=False, default=None, type=int)
+def syn_nnd(config_path, assembly_grp_name, buf_size, seed, n_workers):
     """CLI for `get_synapse_nnds.py/run()`"""
     from assemblyfire.get_synapse_nnds import run
-    run(config_path, assembly_grp_name, buf_size, seed)
+    run(config_path, assembly_grp_name, buf_size, seed, n_workers)
 
 
 @cli.command()
@@ -15,12 +15,15 @@ from tqdm import tqdm
 from hashlib import md5
 import numpy as np
 import pandas as pd
-from joblib import Parallel, delayed
 from scipy.stats import ttest_ind, poisson
 from scipy.sparse import csr_matrix, issparse
-from scipy.spatial.distance import pdist, cdist, squareform
-from scipy.cluster.hierarchy import linkage, fcluster
-from sklearn.metrics import silhouette_score, silhouette_samples, davies_bouldin_score
+from scipy.spatial.distance import pdist, squareform
+from scipy.cluster.hierarchy import fcluster
+try:  # `fastcluster` is a faster (and lower memory) drop-in replacement of scipy's `linkage()`
+    from fastcluster import linkage
+except ImportError:
+    from scipy.cluster.hierarchy import linkage
+from sklearn.metrics import silhouette_score, silhouette_samples
 
 L = logging.getLogger("assemblyfire")
 XYZ = ["x", "y", "z"]
@@ -31,11 +34,28 @@ DSET_PVALUE = "pvalue"
 
 def cosine_similarity(x):
     """Cosine similarity between rows of matrix
-    much faster than `1 - squareform(pdist(x, metrix="cosine"))`"""
+    much faster than `1 - squareform(pdist(x, metrix="cosine"))`
+    (`np.dot()` of an array with its own transpose already dispatches to BLAS' symmetric rank-k update `syrk`,
+    which calculates only one triangle of the result - so `x_norm.T` shouldn't be copied before the product)"""
     x_norm = x / np.linalg.norm(x, axis=-1)[:, np.newaxis]
     return np.dot(x_norm, x_norm.T)
 
 
+def _davies_bouldin_score(x, labels):
+    """Vectorized version of sklearn's `davies_bouldin_score()`
+    (cluster centroids with a single sparse matrix product, instead of looping over clusters)"""
+    _, labels = np.unique(labels, return_inverse=True)
+    counts = np.bincount(labels)
+    onehot = csr_matrix((np.ones(len(labels)), (labels, np.arange(len(labels)))), shape=(len(counts), len(labels)))
+    centroids = (onehot @ x) / counts[:, np.newaxis]
+    intra_dists = np.bincount(labels, weights=np.linalg.norm(x - centroids[labels], axis=1)) / counts
+    centroid_dists = squareform(pdist(centroids))
+    if np.allclose(intra_dists, 0) or np.allclose(centroid_dists, 0):
+        return 0.
+    centroid_dists[centroid_dists == 0] = np.inf
+    return np.mean(np.max((intra_dists[:, np.newaxis] + intra_dists) / centroid_dists, axis=1))
+
+
 # hierarchical clustering (using scipy and sklearn)
 def cluster_sim_mat(spike_matrix, min_n_clusts=5, max_n_clusts=20, n_method="DB"):
     """Hieararchical (Ward linkage) clustering of cosine similarity matrix of significant time bins"""
@@ -43,24 +63,29 @@ def cluster_sim_mat(spike_matrix, min_n_clusts=5, max_n_clusts=20, n_method="DB"
     sim_matrix = cosine_similarity(spike_matrix.T)
     dists = 1 - sim_matrix
     dists[dists < 1e-5] = 0.  # fixing numerical errors
-    cond_dists = squareform(dists)  # squareform implements its inverse if the input is a square matrix
+    cond_dists = squareform(dists, checks=False)  # squareform implements its inverse if the input is a square matrix
 
     linkage_matrix = linkage(cond_dists, method="ward")
 
     # determine number of clusters using silhouette scores or Davies-Bouldin index
+    # (rows of `dists` are the features, whose pairwise distances are calculated only once, not for every `n`,
+    # and only the scores needed for `n_method` are calculated)
+    assert n_method in ["ss", "DB"], "Only silhouette scores and Davies-Bouldin index are supported atm."
+    silhouette_dists = squareform(pdist(dists)) if n_method == "ss" else None
     silhouette_scores, DB_scores = [], []
     for n in range(min_n_clusts, max_n_clusts+1):
         clusters = fcluster(linkage_matrix, n, criterion="maxclust")
-        silhouette_scores.append(silhouette_score(dists, clusters))
-        DB_scores.append(davies_bouldin_score(dists, clusters))
-    assert n_method in ["ss", "DB"], "Only silhouette scores and Davies-Bouldin index are supported atm."
+        if n_method == "ss":
+            silhouette_scores.append(silhouette_score(silhouette_dists, clusters, metric="precomputed"))
+        elif n_method == "DB":
+            DB_scores.append(_davies_bouldin_score(dists, clusters))
     if n_method == "ss":
         n_clust = np.argmax(silhouette_scores) + min_n_clusts
     elif n_method == "DB":
         n_clust = np.argmin(DB_scores) + min_n_clusts
 
     clusters = fcluster(linkage_matrix, int(n_clust), criterion="maxclust")
-    silhouettes = silhouette_samples(dists, clusters) if n_method == "ss" else None
+    silhouettes = silhouette_samples(silhouette_dists, clusters, metric="precomputed") if n_method == "ss" else None
 
     plotting = [linkage_matrix, silhouettes]
     return sim_matrix, clusters - 1, plotting
@@ -78,23 +103,47 @@ def pairwise_correlation_x(sparse_x):
     return cov / (norm + 1e-40)
 
 
+def _center_normalize_rows(x):
+    """Centers and normalizes rows of matrix `x` (constant rows are set to 0)
+    so that the Pearson correlation between the rows of 2 such matrices is a simple dot product"""
+    x = x - np.mean(x, axis=1, keepdims=True)
+    norm = np.linalg.norm(x, axis=1, keepdims=True)
+    return np.divide(x, norm, out=np.zeros_like(x), where=norm > 0)
+
+
 def pairwise_correlation_xy(x, y):
-    """Pairwise correlation between rows of a matrix X and matrix Y"""
-    corrs = 1 - cdist(x, y, metric="correlation")
-    corrs[np.isnan(corrs)] = 0.
-    return corrs
+    """Pairwise correlation between rows of a matrix X and matrix Y
+    much faster (single BLAS matrix product) than `1 - cdist(x, y, metric="correlation")`"""
+    return np.dot(_center_normalize_rows(x), _center_normalize_rows(y).T)
 
 
 def _convert_clusters(clusters):
-    """Convert cluster vector into a matrix form for `cdist()`"""
-    sparse_clusters = np.zeros((len(np.unique(clusters)), clusters.shape[0]), dtype=int)
-    for i in np.unique(clusters):
-        sparse_clusters[i, clusters == i] = 1
-    return sparse_clusters
+    """Convert cluster vector into a sparse (one-hot encoded) matrix form: clusters x time bins"""
+    cluster_ids, cluster_idx = np.unique(clusters, return_inverse=True)
+    return csr_matrix((np.ones(clusters.shape[0], dtype=int), (cluster_idx, np.arange(clusters.shape[0]))),
+                      shape=(len(cluster_ids), clusters.shape[0]))
+
+
+def _one_hot_norms(clusters):
+    """Norms of the centered rows of the one-hot encoded `clusters`
+    (a row with `n` ones out of `T` entries has norm sqrt(n * (1 - n/T)))"""
+    counts = np.asarray(clusters.sum(axis=1), dtype=np.float64).ravel()
+    return np.sqrt(counts * (1 - counts / clusters.shape[1]))
+
+
+def _corr_one_hot(x_n_T, clusters, norms):
+    """Pearson correlation between the rows of the centered and normalized `x_n` (passed as its transpose)
+    and the rows of the sparse one-hot `clusters`. As the rows of `x_n` sum to 0, centering the clusters
+    doesn't change the dot product, thus it reduces to a sparse matrix product (summing entries of `x_n`)"""
+    corrs = np.asarray(clusters @ x_n_T).T
+    return np.divide(corrs, norms, out=np.zeros_like(corrs), where=norms > 0)
 
 
 def corr_spike_matrix_clusters(spike_matrix, clusters):
     """Correlation of cells with clusters (of time bins)"""
+    if issparse(clusters):  # one-hot encoded clusters (see `_convert_clusters()`)
+        x_n_T = np.ascontiguousarray(_center_normalize_rows(spike_matrix).T)
+        return _corr_one_hot(x_n_T, clusters, _one_hot_norms(clusters))
     return pairwise_correlation_xy(spike_matrix, clusters)
 
 
@@ -106,17 +155,46 @@ def corr_shuffled_spike_matrix_clusters(spike_matrix, clusters):
     return corr_spike_matrix_clusters(spike_matrix_rnd, clusters)
 
 
-def sign_corr_ths(spike_matrix, clusters, th_pct, nreps=1000):
+def sign_corr_ths(spike_matrix, clusters, th_pct, nreps=1000, batch_size=50):
     """Generates `N` surrogate datasets and calculates correlation coefficients
-    then takes `th_pct`% percentile of the surrogate datasets as a significance threshold"""
-    nprocs = nreps if os.cpu_count()-1 > nreps else os.cpu_count()-1
-    nprocs = 20 if nprocs > 20 and spike_matrix.shape[1] > 5000 else nprocs  # limit processes to not run out of memory
-    with Parallel(n_jobs=nprocs, prefer="threads") as p:
-        corrs = p(delayed(corr_shuffled_spike_matrix_clusters)(spike_matrix, clusters) for _ in range(nreps))
-    corrs = np.dstack(corrs)  # shape: ngids x nclusters x N
-    # get sign threshold (compare to Monte-Carlo shuffles)
-    corr_ths = np.percentile(corrs, th_pct, axis=2, overwrite_input=True)
-    return corr_ths
+    then takes `th_pct`% percentile of the surrogate datasets as a significance threshold
+    (Shuffling the columns of the spike matrix is equivalent to shuffling the columns of the (much smaller)
+    cluster matrix, thus the spike matrix is centered and normalized only once,
+    and `batch_size` shuffles are correlated with it in a single matrix product)"""
+    x = _center_normalize_rows(spike_matrix)
+    n_clusts, n_bins = clusters.shape
+    if issparse(clusters):  # shuffled one-hot matrices are built directly from the permuted labels
+        x_T = np.ascontiguousarray(x.T)
+        labels = np.asarray(clusters.argmax(axis=0)).ravel()
+        norms = _one_hot_norms(clusters)
+    else:
+        y = _center_normalize_rows(clusters)
+    # only the tail of the surrogate distribution above the percentile is kept (updated after every batch)
+    # instead of all `N` correlations (percentiles below 50 are handled as the upper tail of the negated values)
+    sign, pct = (1., th_pct) if th_pct >= 50 else (-1., 100 - th_pct)
+    h = (nreps - 1) * pct / 100.
+    n_keep = nreps - int(np.floor(h))
+    tail = np.empty((x.shape[0], n_clusts, 0), dtype=x.dtype)  # shape: ngids x nclusters x <= n_keep + batch_size
+    for start in range(0, nreps, batch_size):
+        n = min(batch_size, nreps - start)
+        perm_idx = np.vstack([np.random.permutation(n_bins) for _ in range(n)])
+        if issparse(clusters):
+            rows = (labels[perm_idx] * n + np.arange(n)[:, np.newaxis]).ravel()  # rows: nclusters x n (shuffles)
+            y_rnd = csr_matrix((np.ones(n * n_bins, dtype=int), (rows, np.tile(np.arange(n_bins), n))),
+                               shape=(n_clusts * n, n_bins))
+            corrs = _corr_one_hot(x_T, y_rnd, np.repeat(norms, n))
+        else:
+            y_rnd = y[:, perm_idx].reshape(n_clusts * n, n_bins)  # rows: nclusters x n (shuffles)
+            corrs = np.dot(x, y_rnd.T)
+        corrs = sign * corrs.reshape(x.shape[0], n_clusts, n)
+        tail = np.concatenate((tail, corrs), axis=2)
+        if tail.shape[2] > n_keep:
+            tail = np.partition(tail, tail.shape[2] - n_keep, axis=2)[:, :, -n_keep:]
+    # get sign threshold (compare to Monte-Carlo shuffles) with the same linear interpolation as `np.percentile()`
+    tail.sort(axis=2)
+    lower, upper = tail[:, :, 0], tail[:, :, min(1, n_keep - 1)]
+    corr_ths = lower + (h - np.floor(h)) * (upper - lower)
+    return sign * corr_ths
 
 
 def get_core_cell_idx(spike_matrix, clusters, th_pct):
@@ -135,16 +213,20 @@ def within_cluster_correlations(spike_matrix, core_cell_idx):
     """Compares within cluster correlations (correlation of core cells)
     against the avg. correlation in the whole dataset
     if the within cluster correlation it's higher the cluster is an assembly"""
-    corrs = pairwise_correlation_x(spike_matrix)
-    np.fill_diagonal(corrs, np.nan)
-    mean_corr = np.nanmean(corrs)
-
-    assembly_idx = []
-    for i in range(core_cell_idx.shape[1]):
-        idx = np.where(core_cell_idx[:, i] == 1)[0]
-        if np.nanmean(corrs[np.ix_(idx, idx)]) > mean_corr:
-            assembly_idx.append(i)
-    return assembly_idx
+    corrs = np.asarray(pairwise_correlation_x(spike_matrix))
+    np.fill_diagonal(corrs, 0.)  # (in place, and the diagonal is excluded from all the means below)
+    n = corrs.shape[0]
+    mean_corr = np.sum(corrs) / (n * (n - 1))
+
+    # sums of the within cluster correlations of all clusters at once,
+    # as the diagonal of `M @ corrs @ M.T` (where `M` is the (clusters x cells) membership matrix)
+    # instead of extracting and averaging a submatrix for every cluster
+    members = (core_cell_idx == 1).astype(corrs.dtype)
+    sums = np.einsum("ij,ij->j", members, np.dot(corrs, members))
+    n_members = np.sum(members, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        within_corrs = sums / (n_members * (n_members - 1))  # (NaN for clusters with less than 2 cells)
+    return np.nonzero(within_corrs > mean_corr)[0].tolist()
 
 
 def cluster_spikes(spike_matrix_dict, overwrite_seeds, project_metadata, fig_path):
@@ -248,7 +330,23 @@ def _update_block_diagonal_dists(dists, n_assemblies_cum):
     for i, j in zip(n_assemblies_cum[:-1], n_assemblies_cum[1:]):
         dists[i:j, i:j] = inf_dist
     np.fill_diagonal(dists, 0)
-    return squareform(dists)
+    return squareform(dists, checks=False)
+
+
+def _boolean_dists(x, metric):
+    """Jaccard or Hamming distance between the rows of boolean matrix `x` (in square form)
+    from the number of common elements of all pairs, calculated with a single (BLAS) matrix product"""
+    x = x.astype(np.float64)
+    n_elements = x.sum(axis=1)
+    n_common = np.dot(x, x.T)
+    n_diff = n_elements[:, np.newaxis] + n_elements[np.newaxis, :] - 2 * n_common
+    if metric == "hamming":
+        dists = n_diff / x.shape[1]
+    else:
+        n_union = n_diff + n_common
+        dists = np.divide(n_diff, n_union, out=np.zeros_like(n_diff), where=n_union > 0)
+    np.fill_diagonal(dists, 0.)
+    return dists
 
 
 def cluster_assemblies(assemblies, n_assemblies, distance_metric, linkage_method,
@@ -262,13 +360,17 @@ def cluster_assemblies(assemblies, n_assemblies, distance_metric, linkage_method
     :param update_block_diagonals: see `_update_block_diagonal_dists()` above
     :param n_method: method to determine optimal cluster number
     """
-    cond_dists = pdist(assemblies, metric=distance_metric)
-    dists = squareform(cond_dists)
+    if assemblies.dtype == bool and distance_metric in ["jaccard", "hamming"]:
+        dists = _boolean_dists(assemblies, distance_metric)
+    else:
+        dists = squareform(pdist(assemblies, metric=distance_metric))
     sim_matrix = 1 - dists
     # update block diagonals of the distance matrix to prevent assemblies from the same seed to cluster together
     n_assemblies_cum = [0] + np.cumsum(n_assemblies).tolist()
     if update_block_diagonals:
         cond_dists = _update_block_diagonal_dists(dists, n_assemblies_cum)
+    else:  # (`dists` is a valid distance matrix by construction, so there is no need to validate it)
+        cond_dists = squareform(dists, checks=False)
     # determine n_cluster range: min: max nr. of assemblies in one seed (if it was lower they would cluster together)
     # max: max nr. of assemblies or hard coded 20
     min_n_clusts = np.max(n_assemblies)
@@ -278,15 +380,21 @@ def cluster_assemblies(assemblies, n_assemblies, distance_metric, linkage_method
 
     # determine number of clusters using the combination of silhouette scores or Davies-Bouldin index
     # and the fact that we don't want assemblies from the same seed to cluster together
+    # (only the scores needed for `n_method` are calculated, and none of them if the first valid `n` is used)
+    assert n_method in ["min", "ss", "DB"], "Only silhouette scores and Davies-Bouldin index are supported atm."
+    silhouette_dists = squareform(pdist(dists)) if n_method == "ss" else None  # (see `cluster_sim_mat()` above)
     valid_nclusts, silhouette_scores, DB_scores = [], [], []
     for n in range(min_n_clusts, max_n_clusts+1):
         clusters = fcluster(linkage_matrix, n, criterion="maxclust")
         if _check_seed_separation(clusters, n_assemblies_cum):
             valid_nclusts.append(n)
-            silhouette_scores.append(silhouette_score(dists, clusters))
-            DB_scores.append(davies_bouldin_score(dists, clusters))
+            if n_method == "min":
+                break
+            elif n_method == "ss":
+                silhouette_scores.append(silhouette_score(silhouette_dists, clusters, metric="precomputed"))
+            elif n_method == "DB":
+                DB_scores.append(_davies_bouldin_score(dists, clusters))
     if len(valid_nclusts):
-        assert n_method in ["min", "ss", "DB"], "Only silhouette scores and Davies-Bouldin index are supported atm."
         if n_method == "min":
             n_clust = valid_nclusts[0]
         elif n_method == "ss":
@@ -297,12 +405,32 @@ def cluster_assemblies(assemblies, n_assemblies, distance_metric, linkage_method
         raise RuntimeError("None of the cluster numbers in [%i, %i] fulfill the seed separation criteria"
                            % (min_n_clusts, max_n_clusts))
     clusters = fcluster(linkage_matrix, n_clust, criterion="maxclust")
-    silhouettes = silhouette_samples(dists, clusters) if n_method == "ss" else None
+    silhouettes = silhouette_samples(silhouette_dists, clusters, metric="precomputed") if n_method == "ss" else None
 
     plotting = [linkage_matrix, silhouettes]
     return sim_matrix, clusters - 1, plotting
 
 
+def _assembly_membership_bits(gids, assembly_grp):
+    """Packs the membership of (sorted, unique) `gids` in all assemblies of `assembly_grp` into the bits of
+    uint64 words (one word per 64 assemblies) with a single lookup of all assembly gids"""
+    asm_gids = np.concatenate([assembly.gids for assembly in assembly_grp])
+    asm_idx = np.repeat(np.arange(len(assembly_grp)), [len(assembly.gids) for assembly in assembly_grp])
+    pos = np.searchsorted(gids, asm_gids)
+    valid = pos < len(gids)
+    valid[valid] = gids[pos[valid]] == asm_gids[valid]
+    bits = np.zeros((len(gids), (len(assembly_grp) + 63) // 64), dtype=np.uint64)
+    np.bitwise_or.at(bits, (pos[valid], asm_idx[valid] // 64),
+                     np.left_shift(np.uint64(1), (asm_idx[valid] % 64).astype(np.uint64)))
+    return bits
+
+
+def _nnd(dists, idx):
+    """Nearest neighbour distances within the `idx` subset of `dists` (with NaNs on the diagonal)
+    `np.fmin` skips NaNs in a single pass (`np.nanmin()` would additionally scan for all-NaN columns to warn)"""
+    return np.fmin.reduce(dists[np.ix_(idx, idx)], axis=0)
+
+
 def syn_nearest_neighbour_distances(gid, mpdc, syn_loc_df, assembly_grp, same_section_only=False, n_ctrls=20):
     """
     Calculate nearest neighbour distance for all synaptic locations along the dendrite.
@@ -319,30 +447,37 @@ def syn_nearest_neighbour_distances(gid, mpdc, syn_loc_df, assembly_grp, same_se
     param n_ctrls (int): number of controls to use for t-test
     """
     results = {}
-    for assembly in assembly_grp:
+    # map synapses to their (unique) presynaptic gids once, so that membership tests are done on the unique gids
+    # and broadcast back to synapses with a lookup instead of sorting all synapses for every assembly and control
+    gids, syn_gid_idx = np.unique(syn_loc_df.index.to_numpy(), return_inverse=True)
+    gid_membership = _assembly_membership_bits(gids, assembly_grp)
+    syn_membership = gid_membership[syn_gid_idx]
+    # all pairwise distances are calculated once (assemblies and controls are submatrices of it)
+    # and stored as float32 to halve the memory traffic of gathering the submatrices below
+    pd_all = mpdc.path_distances(syn_loc_df, same_section_only=same_section_only).astype(np.float32)
+    pd_all[pd_all == 0.] = np.NaN  # don't use distance to itself...
+    for i, assembly in enumerate(assembly_grp):
         results[("gid", "gid")] = gid
         results[("assembly%i" % assembly.idx[0], DSET_MEMBER)] = gid in assembly.gids
 
-        from_assembly = np.in1d(syn_loc_df.index.to_numpy(), assembly.gids)
-        from_assembly_count = len(np.intersect1d(syn_loc_df.index.to_numpy(), assembly.gids))
-        if from_assembly.sum() == 0:
+        word, bit = i // 64, np.uint64(1) << np.uint64(i % 64)
+        from_assembly = (syn_membership[:, word] & bit) > 0
+        from_assembly_count = np.count_nonzero(gid_membership[:, word] & bit)
+        if from_assembly_count == 0:
             results[("assembly%i" % assembly.idx[0], DSET_CLST)]: np.NaN
             results[("assembly%i" % assembly.idx[0], DSET_PVALUE)]: np.NaN
             continue
-        pd_data = mpdc.path_distances(syn_loc_df[from_assembly], same_section_only=same_section_only)
-        pd_data[pd_data == 0.] = np.NaN  # don't use distance to itself...
-        nnd_data = np.nanmin(pd_data, axis=0)
+        nnd_data = _nnd(pd_all, np.nonzero(from_assembly)[0])
 
         nnd_ctrl = []
-        gids = np.unique(syn_loc_df.index.to_numpy())
         hash_ = md5(assembly.gids)
         assembly_seed = np.mod(int(hash_.hexdigest(), 16), 1000)
         for seed in range(n_ctrls):
-            np.random.seed(seed * (assembly_seed + gid))
-            from_ctrl = np.in1d(syn_loc_df.index.to_numpy(), np.random.choice(gids, from_assembly_count, replace=False))
-            pd_ctrl = mpdc.path_distances(syn_loc_df[from_ctrl], same_section_only=same_section_only)
-            pd_ctrl[pd_ctrl == 0] = np.NaN
-            nnd_ctrl.append(np.nanmin(pd_ctrl, axis=0))
+            rng = np.random.default_rng(seed * (assembly_seed + gid))
+            gid_in_ctrl = np.zeros(len(gids), dtype=bool)
+            gid_in_ctrl[rng.choice(len(gids), from_assembly_count, replace=False, shuffle=False)] = True
+            from_ctrl = gid_in_ctrl[syn_gid_idx]
+            nnd_ctrl.append(_nnd(pd_all, np.nonzero(from_ctrl)[0]))
 
         a = np.mean(nnd_data)
         b = [np.mean(_ctrl) for _ctrl in nnd_ctrl]
@@ -357,38 +492,52 @@ def syn_nearest_neighbour_distances(gid, mpdc, syn_loc_df, assembly_grp, same_se
 def _create_lookups(loc_df, assembly_grp):
     """Create dicts with synapse idx, and fraction of those (compared to total) for all assemblies
     in the `assembly_grp`. (As neurons can be part of more than 1 assembly, `fracs` won't add up to 1)"""
-    syn_idx, fracs, all_assembly_syn_idx = {}, {}, []
-    nsyns, all_pre_gids = len(loc_df), loc_df["pre_gid"].to_numpy()
+    syn_idx, fracs = {}, {}
+    nsyns = len(loc_df)
+    # presynaptic gids are factorized once, and assembly membership is tested on the unique gids with a hash lookup
+    # (and broadcast back to the synapses), instead of sorting all synapses for every assembly with `np.in1d()`
+    pre_gid_codes, pre_gids = pd.factorize(loc_df["pre_gid"].to_numpy())
+    pre_gids = pd.Index(pre_gids)
+    in_any_assembly = np.zeros(nsyns, dtype=bool)
     for assembly in assembly_grp:
-        idx = np.in1d(all_pre_gids, assembly.gids)
+        pos = pre_gids.get_indexer(assembly.gids)
+        gid_membership = np.zeros(len(pre_gids), dtype=bool)
+        gid_membership[pos[pos >= 0]] = True
+        idx = gid_membership[pre_gid_codes]
         assembly_frac = idx.sum() / len(idx)
         fracs["assembly%i" % assembly.idx[0]] = assembly_frac
-        assembly_idx = np.nonzero(idx)[0]
-        syn_idx["assembly%i" % assembly.idx[0]] = assembly_idx
-        all_assembly_syn_idx.append(assembly_idx)
+        syn_idx["assembly%i" % assembly.idx[0]] = np.nonzero(idx)[0]
+        in_any_assembly |= idx  # neurons can be part of more than 1 assemblies...
     # finds synapses that aren't coming from any assembly
-    all_assembly_syn_idx = np.unique(np.concatenate(all_assembly_syn_idx))  # neurons can be part of more than 1 assemblies...
-    tmp = np.arange(nsyns)
-    non_assembly_syn_idx = tmp[np.in1d(tmp, all_assembly_syn_idx, assume_unique=True, invert=True)]
-    assert (len(all_assembly_syn_idx) + len(non_assembly_syn_idx) == nsyns), "Synapse numbers don't add up..."
+    non_assembly_syn_idx = np.nonzero(~in_any_assembly)[0]
     syn_idx["non_assembly"] = non_assembly_syn_idx
     fracs["non_assembly"] = len(non_assembly_syn_idx) / nsyns
     return syn_idx, fracs
 
 
 def syn_distances(loc_df, mask_col, xzy_cols):
-    """Return (Euclidean) distance between synapses on the same section (the rest is masked with nans)"""
-    dists = squareform(pdist(loc_df[xzy_cols].to_numpy()))
-    mask = squareform(pdist(loc_df[mask_col].to_numpy().reshape(-1, 1)))
-    dists[mask > 0] = np.nan
+    """Return (Euclidean) distance between synapses on the same section (the rest is masked with nans)
+    distances are calculated from a single (BLAS) matrix product as: |x|^2 + |y|^2 - 2xy
+    (after centering the coordinates, to avoid loss of precision for close by synapses far from the origin)"""
+    xyz = loc_df[xzy_cols].to_numpy(dtype=np.float64)
+    xyz = xyz - xyz.mean(axis=0)
+    sq_norms = np.einsum("ij,ij->i", xyz, xyz)
+    dists = np.dot(xyz, xyz.T)
+    dists *= -2
+    dists += sq_norms[:, np.newaxis]
+    dists += sq_norms[np.newaxis, :]
+    np.sqrt(np.maximum(dists, 0, out=dists), out=dists)
+    section_ids = loc_df[mask_col].to_numpy()
+    dists[section_ids[:, np.newaxis] != section_ids[np.newaxis, :]] = np.nan
     np.fill_diagonal(dists, np.nan)
     return dists
 
 
 def distance_model(dists, fracs, target_range, fig_name=None):
     """Creates a cumulative histogram of (valid) inter-synapse distances, fits a line to it
-    and based on the slope returns and underlying Poisson model (the mathematical assumption behind the Poisson is
-    that the distribution should be uniform (histogram should be flat) and the cumulative a straight line)
+    and based on the slope returns the rates of the underlying Poisson models (the mathematical assumption behind
+    the Poisson is that the distribution should be uniform (histogram should be flat) and the cumulative a straight line)
+    (only the rates are returned, as building frozen `scipy.stats` distributions for every gid is slow)
     use fig_name != None to save a figure and visually verify"""
     dists = squareform(dists, checks=False)  # convert back to condensed form to not count every distance twice
     dist_samples = dists[~np.isnan(dists)]
@@ -400,7 +549,10 @@ def distance_model(dists, fracs, target_range, fig_name=None):
     if fig_name is not None:
         from assemblyfire.plots import plot_synapse_distance_dist
         plot_synapse_distance_dist(d_bins, hist, cum, fit, fig_name)
-    return {label: poisson(target_range * slope * frac) for label, frac in fracs.items()}
+    return {label: target_range * slope * frac for label, frac in fracs.items()}
+
+
+_POPCOUNT_TABLE = np.array([bin(i).count("1") for i in range(256)], dtype=np.uint8)
 
 
 def merge_clusters(clusters):
@@ -411,28 +563,31 @@ def merge_clusters(clusters):
     (This is needed as clusters can be detected multiple times at the first place.
     Input `cluster.shape[1]` is the number of raw clusters,
     while output `cluster.shape[1]` is the number of merged clusters)
+    Clusters are bit-packed (8 synapses per byte) and common synapses are counted with a popcount lookup table,
+    and merged clusters are only masked (instead of deleting columns, which would copy the whole matrix)
     """
     row_idx, col_idx = np.nonzero(clusters)
     nsyns = len(np.unique(row_idx))  # number of unique synapses in the passed clusters
     _, counts = np.unique(col_idx, return_counts=True)
     min_nsyns = np.min(counts)  # minimum number of synapses in the passed clusters
     nclusts_ub = int(nsyns / min_nsyns)  # upper bound of possible (meaningfull) clusters
+    packed = np.packbits(clusters.astype(bool), axis=0).T.copy()  # shape: clusters x ceil(synapses / 8)
+    keep = np.ones(packed.shape[0], dtype=bool)
     for nsyns_th in np.arange(min_nsyns-1, 1, -1):
-        i = 0
-        while i < (clusters.shape[1] - 1):
-            idx_partners = np.arange(i + 1, clusters.shape[1])
-            matches = np.sum(clusters[:, [i]] & clusters[:, idx_partners], axis=0) > nsyns_th
-            if not np.any(matches):
-                i += 1
-            else:
-                # idx_partners[matches] are the column indices (`j`s) where cluster `i` has at least 1 common synapse
-                clusters[:, i] = np.any(clusters[:, [i] + idx_partners[matches].tolist()], axis=1)
-                clusters = clusters[:, ~np.in1d(range(clusters.shape[1]), idx_partners[matches])]
-                i += 1
-        row_idx, _ = np.nonzero(clusters)
-        _, counts = np.unique(row_idx, return_counts=True)
-        if np.sum(counts) == nsyns:  # check if all synapses (in the rows) belong to a unique cluster
+        for i in range(packed.shape[0] - 1):
+            if not keep[i]:
+                continue
+            idx_partners = np.nonzero(keep[i + 1:])[0] + i + 1
+            common = _POPCOUNT_TABLE[packed[i] & packed[idx_partners]].sum(axis=1, dtype=np.int64)
+            matches = idx_partners[common > nsyns_th]
+            if len(matches):
+                # `matches` are the row indices (`j`s) where cluster `i` has more than `nsyns_th` common synapses
+                packed[i] |= np.bitwise_or.reduce(packed[matches], axis=0)
+                keep[matches] = False
+        # check if all synapses belong to a unique cluster
+        if _POPCOUNT_TABLE[packed[keep]].sum(dtype=np.int64) == nsyns:
             break
+    clusters = np.unpackbits(packed[keep], axis=1, count=clusters.shape[0]).T.astype(bool)
     assert clusters.shape[1] <= nclusts_ub, "After merging there are still more clusters (%i)" \
                                             "than the theoretical upper bound: %i" % (clusters.shape[1], nclusts_ub)
     return clusters
@@ -459,27 +614,28 @@ def cluster_synapses(loc_df, assembly_grp, target_range, min_nsyns, log_sign_th=
     """
 
     cluster_dfs = []
-    for gid in loc_df["post_gid"].unique():
-        loc_df_gid = loc_df.loc[loc_df["post_gid"] == gid]
+    for gid, loc_df_gid in loc_df.groupby("post_gid", sort=False):  # (groups the DataFrame only once)
         syn_idx_dict, fracs = _create_lookups(loc_df_gid, assembly_grp)
         dists = syn_distances(loc_df_gid, "section_id", XYZ)
         if fig_dir is not None:
             fig_name = os.path.join(fig_dir, "assembly%i_a%i_synapse_dists.png" % (base_assembly_idx, gid))
-            models = distance_model(dists.copy(), fracs, target_range, fig_name=fig_name)
+            lambdas = distance_model(dists, fracs, target_range, fig_name=fig_name)
         else:
-            models = distance_model(dists.copy(), fracs, target_range)
+            lambdas = distance_model(dists, fracs, target_range)  # (`dists` isn't modified, no need to copy)
         labels = list(syn_idx_dict.keys())
         results = -100 * np.ones((dists.shape[0], len(labels)), dtype=int)
+        # distances are thresholded only once (NaNs are never close), and labels gather from the (8x smaller) bool array
+        close = dists < target_range
         for i, label in enumerate(labels):
             syn_idx = syn_idx_dict[label]
             results[syn_idx, i] = -1
-            sub_dists = dists[np.ix_(syn_idx, syn_idx)]
-            nsyns = (sub_dists < target_range).sum(axis=1)
-            p_vals = 1.0 - models[label].cdf(nsyns - 1)
+            sub_close = close[np.ix_(syn_idx, syn_idx)]
+            nsyns = sub_close.sum(axis=1)
+            p_vals = 1.0 - poisson.cdf(nsyns - 1, lambdas[label])
             p_vals[p_vals == 0.0] += 1 / np.power(10, 2*log_sign_th)  # for numerical stability (see log10 below)
             significant = (-np.log10(p_vals) >= log_sign_th) & (nsyns >= min_nsyns)
             if np.any(significant):
-                raw_clusters = sub_dists[:, significant] < target_range
+                raw_clusters = sub_close[:, significant]
                 merged_clusters = merge_clusters(raw_clusters)
                 row_idx, col_idx = np.nonzero(merged_clusters)
                 results[syn_idx[row_idx], i] = col_idx  # set cluster labels (starting at 0)
@@ -4,10 +4,10 @@ last modified: András Ecker 09.2022
 """
 
 import logging
-from conntility.connectivity import ConnectivityMatrix
 
 from assemblyfire.config import Config
 from assemblyfire.utils import get_bluepy_circuit_from_root_path
+from assemblyfire.topology import AssemblyTopology
 
 L = logging.getLogger("assemblyfire")
 
@@ -22,7 +22,7 @@ def run(config_path):
     c = get_bluepy_circuit_from_root_path(config.root_path)
     load_cfg = {"loading": {"base_target": config.target, "properties": ["layer", "x", "y", "z", "mtype",
                                                                          "ss_flat_x", "ss_flat_y", "depth"]}}
-    conn_mat = ConnectivityMatrix.from_bluepy(c, load_cfg, load_full=True,
-                                              connectome="S1nonbarrel_neurons__S1nonbarrel_neurons__chemical")
+    conn_mat = AssemblyTopology.from_bluepy(c, load_cfg, load_full=True,
+                                            connectome="S1nonbarrel_neurons__S1nonbarrel_neurons__chemical")
     conn_mat.to_h5(config.h5f_name, prefix=config.h5_prefix_connectivity, group_name="full_matrix")
 
@@ -5,6 +5,8 @@ authors: Michael Reimann, András Ecker; last modified: 01.2023
 
 import os
 import logging
+from functools import lru_cache
+from multiprocessing import Pool
 from tqdm import tqdm
 import numpy as np
 import pandas as pd
@@ -18,6 +20,10 @@ from assemblyfire.syn_nnd import SynNNDResults
 from assemblyfire.clustering import syn_nearest_neighbour_distances
 
 L = logging.getLogger("assemblyfire")
+_WORKER_ARGS = {}
+# every worker opens its own circuit and caches morphologies, so the default nr. of workers is capped
+# (to not multiply memory usage with the nr. of cores on big nodes; pass `n_workers` explicitly to use more)
+_MAX_DEFAULT_WORKERS = 8
 
 
 def _assembly_group_from_name(config, assembly_grp_name):
@@ -38,14 +44,51 @@ def _assembly_group_from_name(config, assembly_grp_name):
 
 
 def _get_assembly_indegrees(assembly_grp, conn_mat, gids):
-    """Gets indegrees from each assembly in the `assembly_grp` for all `gids`"""
-    assembly_indegrees = [conn_mat.degree(assembly.gids, gids) for assembly in assembly_grp.assemblies]
-    return np.vstack(assembly_indegrees).transpose()
+    """Gets indegrees from each assembly in the `assembly_grp` for all `gids`
+    (as a single product of the assemblies x gids membership matrix and the columns of the connectivity matrix
+    instead of extracting (and summing) one submatrix per assembly)"""
+    m = conn_mat.matrix_(fmt="csc")[:, conn_mat._lookup_gather(gids)]
+    if m.dtype == bool:
+        m = m.astype(np.int32)  # to use the numerical (not the boolean) sparse matrix product
+    membership = assembly_grp.as_sparse(conn_mat.gids).astype(m.dtype)
+    return (membership @ m).toarray().transpose()
 
 
-def run(config_path, assembly_grp_name, buf_size, seed):
+def _worker_init(root_path, edge_pop, gids, morph_root, morphs, assembly_grp):
+    """Opens the circuit once per worker process (as circuits and morphologies don't pickle cleanly)
+    and stores it together with the rest of the shared arguments in a module level global"""
+    _WORKER_ARGS["c"] = utils.get_bluepy_circuit_from_root_path(root_path)
+    gid_lookup = np.zeros(np.max(gids) + 1, dtype=bool)  # for fast membership test of presynaptic gids
+    gid_lookup[gids] = True
+    _WORKER_ARGS.update({"edge_pop": edge_pop, "gid_lookup": gid_lookup, "morph_root": morph_root,
+                         "morphs": morphs, "assembly_grp": assembly_grp})
+
+
+@lru_cache(maxsize=512)
+def _get_mpdc(morph_name):
+    """Reads morphology and builds path distance calculator (cached, as many gids share the same morphology)"""
+    morph = Morphology(os.path.join(_WORKER_ARGS["morph_root"], morph_name) + ".asc")
+    return MorphologyPathDistanceCalculator(morph)
+
+
+def _process_gid(args):
+    """Calculates synapse nearest neighbour distances for a single gid (in a worker process)"""
+    gid, gid_indegrees = args
+    c, assembly_grp = _WORKER_ARGS["c"], _WORKER_ARGS["assembly_grp"]
+    mpdc = _get_mpdc(_WORKER_ARGS["morphs"].loc[gid])
+    syn_loc_df = utils.get_gid_synloc_df(c, gid, _WORKER_ARGS["edge_pop"])
+    pre_gids, gid_lookup = syn_loc_df.index.to_numpy(), _WORKER_ARGS["gid_lookup"]
+    syn_loc_df = syn_loc_df.loc[(pre_gids < len(gid_lookup)) & gid_lookup[np.minimum(pre_gids, len(gid_lookup) - 1)]]
+    clst_dict = syn_nearest_neighbour_distances(gid, mpdc, syn_loc_df, assembly_grp)
+    # adding assembly indegrees to the dataset (for faster analysis afterwards)
+    for assembly, assembly_indegree in zip(assembly_grp, gid_indegrees):
+        clst_dict[("assembly%i" % assembly.idx[0], SynNNDResults.DSET_DEG)] = assembly_indegree
+    return clst_dict
+
+
+def run(config_path, assembly_grp_name, buf_size, seed, n_workers=None):
     """Calculates synapse nearest neighbour distances for assembly synapses and random controls,
-    and keeps writing the results to HDF5"""
+    and keeps writing the results to HDF5 (gids are processed in parallel, but written by the main process)"""
 
     config = Config(config_path)
     assembly_grp = _assembly_group_from_name(config, assembly_grp_name)
@@ -60,32 +103,37 @@ def run(config_path, assembly_grp_name, buf_size, seed):
     gids2run = np.intersect1d(gids, conn_mat.gids)  # just to make sure...
     total = len(gids2run)
     gids_done = np.sort(np.unique(results._df[("gid", "gid")].values.astype(int)))
-    assert np.in1d(gids_done, gids2run).all()
+    assert (pd.Index(gids2run).get_indexer(gids_done) >= 0).all()
     gids2run = np.setdiff1d(gids2run, gids_done, assume_unique=True)
-    np.random.seed(seed)
-    gids_rnd = np.random.permutation(gids2run)
+    gids_rnd = np.random.default_rng(seed).permutation(gids2run)
+    # group gids sharing the same morphology (keeping the random order within groups) to reuse cached morphologies
+    gids_rnd = gids_rnd[np.argsort(morphs.loc[gids_rnd].to_numpy(), kind="stable")]
     L.info(" Getting synapse nearest neighbour distance for %i / %i gids " % (len(gids_rnd), len(gids)))
 
     indegree_mat = _get_assembly_indegrees(assembly_grp, conn_mat, gids_rnd)
 
-    pbar, buf = tqdm(total=total, initial=results._written, miniters=buf_size), []
-    for gid, gid_indegrees in zip(gids_rnd, indegree_mat):
-        pbar.update()
-        # prepare args, and calculate synapse nearest neighbour distance
-        mpdc = MorphologyPathDistanceCalculator(Morphology(os.path.join(morph_root, morphs.loc[gid]) + ".asc"))
-        syn_loc_df = utils.get_gid_synloc_df(c, gid, config.edge_pop)
-        syn_loc_df = syn_loc_df.loc[syn_loc_df.index.intersection(gids)]
-        clst_dict = syn_nearest_neighbour_distances(gid, mpdc, syn_loc_df, assembly_grp)
-        # adding assembly indegrees to the dataset (for faster analysis afterwards)
-        for assembly, assembly_indegree in zip(assembly_grp, gid_indegrees):
-            clst_dict[("assembly%i" % assembly.idx[0], SynNNDResults.DSET_DEG)] = assembly_indegree
-        # write to file when buffer is full
-        buf.append(clst_dict)
-        if len(buf) >= buf_size:
-            results.append(pd.DataFrame.from_records(buf))
-            results.flush()
-            buf = []
+    # results are buffered in a preallocated (float) array with one column per result (instead of a list of dicts)
+    cols = [("gid", "gid")] + [("assembly%i" % assembly.idx[0], dset) for assembly in assembly_grp
+                               for dset in [SynNNDResults.DSET_MEMBER, SynNNDResults.DSET_CLST,
+                                            SynNNDResults.DSET_PVALUE, SynNNDResults.DSET_DEG]]
+    col_idx, cols = {col: i for i, col in enumerate(cols)}, pd.MultiIndex.from_tuples(cols)
+    buf, n_buf = np.full((buf_size, len(cols)), np.nan), 0
+
+    if n_workers is None:
+        n_workers = min(max(os.cpu_count() - 1, 1), _MAX_DEFAULT_WORKERS)
+    pbar = tqdm(total=total, initial=results._written, miniters=buf_size)
+    with Pool(processes=n_workers, initializer=_worker_init,
+              initargs=(config.root_path, config.edge_pop, gids, morph_root, morphs, assembly_grp)) as pool:
+        for clst_dict in pool.imap_unordered(_process_gid, zip(gids_rnd, indegree_mat), chunksize=4):
+            pbar.update()
+            for col, val in clst_dict.items():
+                buf[n_buf, col_idx[col]] = val
+            n_buf += 1
+            # write to file (only from the main process) when buffer is full
+            if n_buf == buf_size:
+                results.append(pd.DataFrame(buf, columns=cols))
+                results.flush()
+                buf, n_buf = np.full((buf_size, len(cols)), np.nan), 0
     # write the last part of the results to file as well...
-    results.append(pd.DataFrame.from_records(buf))
+    results.append(pd.DataFrame(buf[:n_buf], columns=cols))
     results.flush()
-
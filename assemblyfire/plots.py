@@ -343,22 +343,26 @@ def plot_assemblies(core_cell_idx, assembly_idx, gids, loc_df, fig_name):
     y_range = [loc_df["ss_flat_y"].min(), loc_df["ss_flat_y"].max()]
     extent = (x_range[0], x_range[1], y_range[0], y_range[1])
     depth_range = [loc_df["depth"].min(), loc_df["depth"].max()]
+    # gids are looked up in the index only once (and assemblies are indexed by position below)
+    gid_idx = loc_df.index.get_indexer(gids)
+    assert (gid_idx >= 0).all(), "All gids should be in `loc_df`"
+    locs = loc_df[["ss_flat_x", "ss_flat_y", "depth"]].to_numpy()[gid_idx]
 
     fig = plt.figure(figsize=(18, 10))
     n_rows = np.floor_divide(n, 5) + 1 if np.mod(n, 5) != 0 else int(n/5)
     gs = gridspec.GridSpec(2 * n_rows, 5)
     for i, assembly_id in enumerate(assembly_idx):
-        assembly_gids = gids[core_cell_idx[:, assembly_id] == 1]
+        assembly_locs = locs[core_cell_idx[:, assembly_id] == 1]
         ax = fig.add_subplot(gs[2 * np.floor_divide(i, 5), np.mod(i, 5)])
-        ax.hexbin(loc_df.loc[assembly_gids, "ss_flat_x"].to_numpy(), loc_df.loc[assembly_gids, "ss_flat_y"].to_numpy(),
+        ax.hexbin(assembly_locs[:, 0], assembly_locs[:, 1],
                   cmap=colors.LinearSegmentedColormap.from_list("assembly", [(1, 1, 1), cmap(i)], N=5),
                   gridsize=50, bins="log", extent=extent)
         ax.set_aspect("equal", "box")
-        ax.set_title("Assembly %i (n=%i)" % (assembly_id, len(assembly_gids)))
+        ax.set_title("Assembly %i (n=%i)" % (assembly_id, len(assembly_locs)))
         ax.set_xticks([]); ax.set_yticks([])
         ax.set_xlim(x_range); ax.set_ylim(y_range)
         ax2 = fig.add_subplot(gs[2 * np.floor_divide(i, 5) + 1, np.mod(i, 5)])
-        ax2.hist(loc_df.loc[assembly_gids, "depth"].to_numpy(), bins=50, range=depth_range, orientation="horizontal",
+        ax2.hist(assembly_locs[:, 2], bins=50, range=depth_range, orientation="horizontal",
                  color=cmap(assembly_id), edgecolor=cmap(assembly_id))
         ax2.set_xticks([])
         ax2.set_yticks(yticks)
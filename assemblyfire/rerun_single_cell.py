@@ -29,8 +29,10 @@ def get_gid_instantiation_vars(ssim):
     return pre_gids, proj_spike_trains, ca.config.bc.Run_Default.SpikeLocation
 
 
-def run_sim(ssim, gid, pre_gids, pre_spike_trains, spike_loc, passive_dends=False, block_nmda=False, tstop=None):
-    """Reruns simulation of a single `gid` w/ all the inputs from the network simulation"""
+def run_sim(ssim, gid, pre_gids, pre_spike_trains, spike_loc, passive_dends=False, block_nmda=False, tstop=None,
+            condition="baseline"):
+    """Reruns simulation of a single `gid` w/ all the inputs from the network simulation
+    (`condition` is only used to label the returned spikes)"""
     # instantiate gid with replay on all synapses and the same input as it gets in the network simulation
     ssim.instantiate_gids([gid], add_synapses=True, add_projections=True, add_minis=True, intersect_pre_gids=pre_gids,
                           add_stimuli=True, add_replay=True, pre_spike_trains=pre_spike_trains)
@@ -41,8 +43,12 @@ def run_sim(ssim, gid, pre_gids, pre_spike_trains, spike_loc, passive_dends=Fals
     spike_vec = bglibpy.neuron.h.Vector()
     nc.record(spike_vec)
     # record voltage from all sections (not just the soma...) built in BGLibPy fn. ignores `record_dt`
+    # (recording names and DF columns are built once, and reused when reading the recordings)
+    rec_names, columns = [], []
     for section in cell.all:
-        cell.add_recording("neuron.h." + section.name() + "(0.5)._ref_v", dt=ssim.record_dt)
+        rec_names.append("neuron.h." + section.name() + "(0.5)._ref_v")
+        columns.append(section.name().split(".")[1])
+        cell.add_recording(rec_names[-1], dt=ssim.record_dt)
 
     # make dendrites passive
     if passive_dends:
@@ -69,15 +75,18 @@ def run_sim(ssim, gid, pre_gids, pre_spike_trains, spike_loc, passive_dends=Fals
     # run simulation
     ssim.run(t_stop=tstop)
 
-    # return spike times as DF (more columns to be added later...)
+    # return spike times (and the condition) as DF (built with all its columns at once)
     spike_times = spike_vec.as_numpy()
-    spikes = pd.DataFrame(data=spike_times[spike_times > 0], columns=["spike_times"])
+    spike_times = spike_times[spike_times > 0]
+    spikes = pd.DataFrame({"spike_times": spike_times, "condition": np.full(len(spike_times), condition, dtype=object)})
     # get voltage recordings from all sections and create DF
-    data, columns = [], []
-    for section in cell.all:
-        columns.append(section.name().split(".")[1])
-        data.append(cell.get_recording("neuron.h." + section.name() + "(0.5)._ref_v").reshape(-1, 1))
-    vs = pd.DataFrame(data=np.hstack(data), columns=columns, index=cell.get_time())
+    # (copied directly into a preallocated array, instead of `np.hstack()`-ing single columns,
+    # and stored as float32 which is plenty for mV and halves the size of the saved DFs)
+    t = cell.get_time()
+    data = np.empty((len(t), len(columns)), dtype=np.float32)
+    for i, rec_name in enumerate(rec_names):
+        data[:, i] = cell.get_recording(rec_name)
+    vs = pd.DataFrame(data=data, columns=columns, index=t, copy=False)
     vs.index.name = "time"
 
     return spikes, vs
@@ -99,9 +108,9 @@ def run(config_path, seed, gid):
     ssim = utils.get_bglibpy_ssim(sim_path)
     pre_gids, pre_spike_trains, spike_loc = get_gid_instantiation_vars(ssim)
     spikes, vs = run_sim(ssim, gid, pre_gids, pre_spike_trains, spike_loc)
-    spikes["condition"] = "baseline"
-    spikes.to_pickle(os.path.join(save_dir, "seed%s_a%i_spikes.pkl" % (seed, gid)))
-    vs.to_pickle(os.path.join(save_dir, "seed%s_a%i_baseline_voltages.pkl" % (seed, gid)))
+    spike_dfs = [spikes]  # (spikes from all conditions are concatenated from this list before saving)
+    spikes.to_pickle(os.path.join(save_dir, "seed%s_a%i_spikes.pkl" % (seed, gid)), protocol=5)
+    vs.to_pickle(os.path.join(save_dir, "seed%s_a%i_baseline_voltages.pkl" % (seed, gid)), protocol=5)
     ssim.delete()
     gc.collect()
     t2 = time.time()
@@ -109,12 +118,12 @@ def run(config_path, seed, gid):
 
     L.info(" Running sim. w/ passive dendrites ")
     ssim = utils.get_bglibpy_ssim(sim_path)
-    spikes_, vs = run_sim(ssim, gid, pre_gids, pre_spike_trains, spike_loc, passive_dends=True)
-    spikes_["condition"] = "passivedend"
-    spikes = pd.concat([spikes, spikes_], ignore_index=True)
-    spikes = spikes.sort_values("spike_times")
-    spikes.to_pickle(os.path.join(save_dir, "seed%s_a%i_spikes.pkl" % (seed, gid)))
-    vs.to_pickle(os.path.join(save_dir, "seed%s_a%i_passivedend_voltages.pkl" % (seed, gid)))
+    spikes, vs = run_sim(ssim, gid, pre_gids, pre_spike_trains, spike_loc, passive_dends=True,
+                         condition="passivedend")
+    spike_dfs.append(spikes)
+    spikes = pd.concat(spike_dfs, ignore_index=True).sort_values("spike_times")
+    spikes.to_pickle(os.path.join(save_dir, "seed%s_a%i_spikes.pkl" % (seed, gid)), protocol=5)
+    vs.to_pickle(os.path.join(save_dir, "seed%s_a%i_passivedend_voltages.pkl" % (seed, gid)), protocol=5)
     ssim.delete()
     gc.collect()
     t3 = time.time()
@@ -122,12 +131,11 @@ def run(config_path, seed, gid):
 
     L.info(" Running sim. w/ NMDA channels blocked ")
     ssim = utils.get_bglibpy_ssim(sim_path)
-    spikes_, vs = run_sim(ssim, gid, pre_gids, pre_spike_trains, spike_loc, block_nmda=True)
-    spikes_["condition"] = "noNMDA"
-    spikes = pd.concat([spikes, spikes_], ignore_index=True)
-    spikes = spikes.sort_values("spike_times")
-    spikes.to_pickle(os.path.join(save_dir, "seed%s_a%i_spikes.pkl" % (seed, gid)))
-    vs.to_pickle(os.path.join(save_dir, "seed%s_a%i_noNMDA_voltages.pkl" % (seed, gid)))
+    spikes, vs = run_sim(ssim, gid, pre_gids, pre_spike_trains, spike_loc, block_nmda=True, condition="noNMDA")
+    spike_dfs.append(spikes)
+    spikes = pd.concat(spike_dfs, ignore_index=True).sort_values("spike_times")
+    spikes.to_pickle(os.path.join(save_dir, "seed%s_a%i_spikes.pkl" % (seed, gid)), protocol=5)
+    vs.to_pickle(os.path.join(save_dir, "seed%s_a%i_noNMDA_voltages.pkl" % (seed, gid)), protocol=5)
     ssim.delete()
     gc.collect()
     t4 = time.time()
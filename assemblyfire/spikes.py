@@ -12,7 +12,7 @@ import gc
 import warnings
 from tqdm import tqdm
 from tqdm.contrib import tzip
-from collections import namedtuple, OrderedDict
+from collections import OrderedDict
 import h5py
 import numpy as np
 from scipy.ndimage import gaussian_filter1d
@@ -20,8 +20,29 @@ from scipy.spatial.distance import squareform
 from joblib import Parallel, delayed
 
 from assemblyfire.config import Config
+try:  # bitshuffle + LZ4 compresses the (sparse, integer valued) spike matrices better and decompresses faster
+    import hdf5plugin
+    SPIKE_MATRIX_COMPRESSION = dict(hdf5plugin.Bitshuffle(cname="lz4"))
+except ImportError:
+    SPIKE_MATRIX_COMPRESSION = {"compression": "gzip"}
 
-SpikeMatrixResult = namedtuple("SpikeMatrixResult", ["spike_matrix", "gids", "t_bins"])
+
+class SpikeMatrixResult(object):
+    """Binned spikes (`spike_matrix`: gids x t_bins), with their `gids` and `t_bins`
+    (`__slots__` instead of a namedtuple, but can still be unpacked as one)"""
+    __slots__ = ("spike_matrix", "gids", "t_bins")
+
+    def __init__(self, spike_matrix, gids, t_bins):
+        self.spike_matrix = spike_matrix
+        self.gids = gids
+        self.t_bins = t_bins
+
+    def __iter__(self):
+        return iter((self.spike_matrix, self.gids, self.t_bins))
+
+    def __repr__(self):
+        return "SpikeMatrixResult(spike_matrix=%s, gids=%s, t_bins=%s)" % (self.spike_matrix.shape, len(self.gids),
+                                                                            len(self.t_bins))
 
 
 def load_spikes(f_name, node_pop, target, t_start, t_end):
@@ -35,9 +56,9 @@ def load_spikes(f_name, node_pop, target, t_start, t_end):
     elif ext == ".h5":  # assumes valid SONATA spike file
         from libsonata import SpikeReader
         reader = SpikeReader(f_name)[node_pop]
-        spikes = np.array(reader.get(tstart=t_start, tstop=t_end))
-        spike_times = spikes[:, 1]
-        spiking_gids = spikes[:, 0].astype(int)
+        spikes = reader.get_dict(tstart=t_start, tstop=t_end)  # arrays (instead of a list of tuples with `get()`)
+        spike_times = np.asarray(spikes["timestamps"], dtype=np.float64)
+        spiking_gids = np.asarray(spikes["node_ids"], dtype=np.int64)
     else:
         NotImplementedError("Handling file extension: %s is not implemented")
     return spike_times, spiking_gids
@@ -113,13 +134,15 @@ def convolve_spike_matrix(sim_config_path, node_pop, target, t_start, t_end, bin
 
 def spikes_to_h5(h5f_name, spike_matrix_dict, metadata, prefix):
     """Saves spike matrices to HDF5 file"""
+    from assemblyfire.utils import _downcast_spike_matrix
     with h5py.File(h5f_name, "a") as h5f:
         grp = h5f.require_group(prefix)
         for k, v in metadata.items():
             grp.attrs[k] = v
         for seed, SpikeMatrixResult in spike_matrix_dict.items():
             grp_out = grp.create_group("seed%s" % seed)
-            grp_out.create_dataset("spike_matrix", data=SpikeMatrixResult.spike_matrix, compression="gzip")
+            grp_out.create_dataset("spike_matrix", data=_downcast_spike_matrix(SpikeMatrixResult.spike_matrix),
+                                   **SPIKE_MATRIX_COMPRESSION)
             grp_out.create_dataset("gids", data=SpikeMatrixResult.gids)
             grp_out.create_dataset("t_bins", data=SpikeMatrixResult.t_bins)
 
@@ -253,10 +276,7 @@ class SpikeMatrixGroup(Config):
             del convolved_spike_matrix
             gc.collect()
         # build #gids matrices from trials and calculate pairwise correlation between rows
-        indiv_gids = []
-        for _, gids in gid_dict.items():
-            indiv_gids.extend(gids)
-        all_gids = np.unique(indiv_gids)
+        all_gids = np.unique(np.concatenate(list(gid_dict.values())))
         r_spikes = np.zeros_like(all_gids, dtype=np.float32)
         for i, gid in enumerate(tqdm(all_gids, desc="Concatenating results for all gids", miniters=len(all_gids) / 100)):
             # array of single neuron across trials with <=len(seed) rows
@@ -50,10 +50,23 @@ class SynNNDResults(object):
             df_dict[("assembly%i" % i, self.DSET_PVALUE)] = []
             df_dict[("assembly%i" % i, self.DSET_DEG)] = []
         
-        self._df = pd.DataFrame(df_dict)
-        self._df = self._df[["gid"] + sorted([_x for _x in self._df.columns.levels[0] if _x != "gid"])]
+        df = pd.DataFrame(df_dict)
+        self._df = df[["gid"] + sorted([_x for _x in df.columns.levels[0] if _x != "gid"])]
 
         self._initialize_file(n_assemblies)
+
+    @property
+    def _df(self):
+        """All results in a single DataFrame. Appended results are only concatenated to it when it's accessed
+        (instead of growing the DataFrame, i.e., copying all previous results, at every `append()`)"""
+        if len(self._frames):
+            self._merged_df = pd.concat([self._merged_df] + self._frames, axis=0)
+            self._frames = []
+        return self._merged_df
+
+    @_df.setter
+    def _df(self, df):
+        self._merged_df, self._frames, self._unwritten_frames = df, [], []
     
     @staticmethod
     def _sorted_df(df_in):
@@ -72,12 +85,13 @@ class SynNNDResults(object):
     def unwritten_rows(self):
         write_order = [self.DSET_MEMBER, self.DSET_CLST, self.DSET_PVALUE, self.DSET_DEG]
         unwritten = {}
+        # only the results appended since the last `flush()` are concatenated (to the empty, but complete, columns)
+        unwritten_df = pd.concat([self._merged_df.iloc[:0]] + self._unwritten_frames, axis=0)
 
         for str_dset in write_order:
-            df = self._df.reorder_levels([1, 0], axis="columns")[["gid", str_dset]].droplevel(0, "columns")
+            df = unwritten_df.reorder_levels([1, 0], axis="columns")[["gid", str_dset]].droplevel(0, "columns")
             df = SynNNDResults._sorted_df(df)
-            assert len(df) >= self._written
-            unwritten[str_dset] = df.iloc[self._written:].values.astype(float)
+            unwritten[str_dset] = df.values.astype(float)
         return unwritten
     
     def flush(self):
@@ -90,14 +104,16 @@ class SynNNDResults(object):
                 dset = h5[self.DSET_PREFIX][str_dset]
                 self._append_single(df, dset, self._written)
             h5.flush()
-        self._written = len(self._df)
+        self._written += sum(len(df) for df in self._unwritten_frames)
+        self._unwritten_frames = []
     
     def append(self, other):
         """Append new results to the object.
         param other (pd.DataFrame): A pandas DataFrame with new results to append.
                                     Columns must be a subset of the columns in obj._df"""
         # TODO: Basic compatibility checks
-        self._df = pd.concat([self._df, other], axis=0)
+        self._frames.append(other)
+        self._unwritten_frames.append(other)
 
     def _initialize_file(self, n_assemblies):
         # TODO: URGENT: Save / restore column names in file, instead of this implicit encoding!
@@ -119,5 +135,5 @@ class SynNNDResults(object):
                 for i, assembly_name in zip(range(n_assemblies), assembly_names):
                     existing_dict[(assembly_name, dset_str)] = dset[:, i + 1]
         self.append(pd.DataFrame.from_records(existing_dict))
-        self._written = len(self._df)
+        self._written, self._unwritten_frames = len(self._df), []
 
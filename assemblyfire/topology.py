@@ -4,35 +4,216 @@ authors: Daniela Egas Santander, Nicolas Ninin, András Ecker
 last modified: 01.2023
 """
 
+import warnings
 from tqdm import tqdm
+import h5py
 import numpy as np
 import pandas as pd
+from scipy.sparse import csr_matrix, csc_matrix
 from scipy.stats import binom
 
 import assemblyfire.discrete_random_variable as drv
 from conntility.connectivity import ConnectivityMatrix
 
 
+def _extract_submatrix(csr, rows, cols):
+    """Extracts `csr[rows, :][:, cols]` by slicing the rows and then keeping (and renumbering)
+    the nonzeros in `cols` with a lookup array, in a single pass over the nonzeros of the selected rows"""
+    m = csr[rows]
+    col_map = np.full(csr.shape[1], -1, dtype=np.int64)
+    col_map[cols] = np.arange(len(cols))
+    if np.count_nonzero(col_map >= 0) != len(cols):  # repeated columns can't be remapped this way
+        return m[:, cols]
+    new_cols = col_map[m.indices]
+    keep = new_cols >= 0
+    row_idx = np.repeat(np.arange(len(rows)), np.diff(m.indptr))
+    indptr = np.zeros(len(rows) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row_idx[keep], minlength=len(rows)), out=indptr[1:])
+    return csr_matrix((m.data[keep], new_cols[keep], indptr), shape=(len(rows), len(cols)))
+
+
 class AssemblyTopology(ConnectivityMatrix):
     """
     A class derived from ConnectivityMatrix with additional information on networks metrics
     of the subgraph associated to an assembly within the connectivity matrix of the circuit.
     """
+    # HDF5 files written by `to_h5()` store the edges as CSR arrays (which `conntility` can't read)
+    # thus they are tagged with a distinct class name and a format version
+    H5_CLASS = "AssemblyTopology"
+    H5_FORMAT_VERSION = 1
+
+    def __init__(self, *args, **kwargs):
+        super(AssemblyTopology, self).__init__(*args, **kwargs)
+        self._matrix_cache = {}
+        # plain array (gid - min(gid) -> index) to replace the `pd.Series` in `self._lookup` for (dense) integer gids
+        self._lookup_arr, self._lookup_offset = None, 0
+        gids = self._vertex_properties.index.to_numpy()
+        if len(gids) and np.issubdtype(gids.dtype, np.integer) and gids.max() - gids.min() < 4 * len(gids):
+            self._lookup_offset = gids.min()
+            self._lookup_arr = np.full(gids.max() - gids.min() + 1, -1, dtype=np.int64)
+            self._lookup_arr[gids - self._lookup_offset] = np.arange(len(gids))
+
+    def _lookup_gather(self, gids):
+        """Maps `gids` to row/column indices (with a gather from the array lookup built above if possible,
+        instead of the per element hash lookups of the `pd.Series` in `self._lookup`)"""
+        if self._lookup_arr is None:
+            return self._lookup[gids].to_numpy()
+        gids = np.asarray(gids) - self._lookup_offset
+        valid = (gids >= 0) & (gids < len(self._lookup_arr))
+        idx = self._lookup_arr[gids[valid]]
+        if not valid.all() or np.any(idx < 0):
+            raise KeyError("Not all gids are part of the connectivity matrix")
+        return idx
+
+    def add_edge_property(self, new_label, new_values):
+        """Same as `ConnectivityMatrix.add_edge_property()` but invalidates the cached sparse matrices"""
+        super(AssemblyTopology, self).add_edge_property(new_label, new_values)
+        self._matrix_cache = {}
+
+    def matrix_(self, edge_property=None, fmt="coo"):
+        """Same as `ConnectivityMatrix.matrix_()` but the sparse matrix is only built once (per edge property)
+        and cached (optionally in CSR or CSC format as well for fast row and column slicing)"""
+        if edge_property is None:
+            edge_property = self._default_edge
+        key = (edge_property, fmt)
+        if key not in self._matrix_cache:
+            if fmt == "coo":
+                self._matrix_cache[key] = super(AssemblyTopology, self).matrix_(edge_property)
+            else:
+                matrix = self._compressed_matrix_(edge_property, fmt) if fmt in ["csr", "csc"] else None
+                self._matrix_cache[key] = self.matrix_(edge_property).asformat(fmt) if matrix is None else matrix
+        return self._matrix_cache[key]
+
+    def _compressed_matrix_(self, edge_property, fmt):
+        """Builds CSR (CSC) matrix directly from the edges if they are sorted by rows (columns),
+        e.g. as read by `from_h5()` below, skipping the sort of the COO -> CSR (CSC) conversion"""
+        major, minor = ("row", "col") if fmt == "csr" else ("col", "row")
+        major_idx = self._edge_indices[major].to_numpy()
+        if np.any(major_idx[1:] < major_idx[:-1]):
+            return None
+        n = self._shape[0] if fmt == "csr" else self._shape[1]
+        indptr = np.zeros(n + 1, dtype=np.int64)
+        np.cumsum(np.bincount(major_idx, minlength=n), out=indptr[1:])
+        matrix_class = csr_matrix if fmt == "csr" else csc_matrix
+        return matrix_class((self._edges[edge_property].to_numpy(), self._edge_indices[minor].to_numpy(), indptr),
+                            shape=self._shape)
+
+    def submatrix(self, sub_gids, edge_property=None, sub_gids_post=None):
+        """Same as `ConnectivityMatrix.submatrix()` but extracts it from the cached CSR matrix
+        (instead of the fancy indexing of a freshly converted CSC one)"""
+        pre_idx = self._lookup_gather(self.__extract_vertex_ids__(sub_gids))
+        if sub_gids_post is None:
+            post_idx = pre_idx
+        else:
+            post_idx = self._lookup_gather(self.__extract_vertex_ids__(sub_gids_post))
+        return _extract_submatrix(self.matrix_(edge_property, fmt="csr"), pre_idx, post_idx)
+
+    def subpopulation(self, subpop_ids):
+        """Same as `ConnectivityMatrix.subpopulation()` but filters and renumbers the edges in a single pass
+        with a scatter array (instead of `isin()`s and a per column `apply()` of a pandas lookup)"""
+        subpop_ids = self.__extract_vertex_ids__(subpop_ids)
+        subpop_idx = self._lookup_gather(subpop_ids)  # (raises KeyError if not all `subpop_ids` are in the matrix)
+        remap = np.full(len(self), -1, dtype=np.int64)
+        remap[subpop_idx] = np.arange(len(subpop_idx))
+        rows = remap[self._edge_indices["row"].to_numpy()]
+        cols = remap[self._edge_indices["col"].to_numpy()]
+        vld = (rows >= 0) & (cols >= 0)
+        out_indices = pd.DataFrame({"row": rows[vld], "col": cols[vld]})
+        return self.__class__(out_indices, vertex_properties=self._vertex_properties.loc[subpop_ids],
+                              edge_properties=self._edges.loc[vld].reset_index(drop=True),
+                              default_edge_property=self._default_edge,
+                              shape=(len(subpop_ids), len(subpop_ids)))
+
+    def to_h5(self, fn, group_name=None, prefix=None):
+        """Same as `ConnectivityMatrix.to_h5()` but saves the edges as CSR arrays
+        (`indptr`, `indices`, and one data array per edge property) instead of pandas DataFrames.
+        The group is tagged as `AssemblyTopology` (not `ConnectivityMatrix`), as only `from_h5()` below can read it"""
+        prefix = "connectivity" if prefix is None else prefix
+        group_name = "full_matrix" if group_name is None else group_name
+        full_prefix = prefix + "/" + group_name
+        self._vertex_properties.to_hdf(fn, key=full_prefix + "/vertex_properties", format="table")
+        rows, cols = self._edge_indices["row"].to_numpy(), self._edge_indices["col"].to_numpy()
+        order = np.lexsort((cols, rows))
+        indptr = np.zeros(self._shape[0] + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=self._shape[0]), out=indptr[1:])
+        with h5py.File(fn, "a") as h5:
+            data_grp = h5[full_prefix]
+            for key in ["edges", "edge_indices", "csr_indptr", "csr_indices", "csr_data"]:
+                if key in data_grp:  # delete edges saved in any format before
+                    del data_grp[key]
+            data_grp.create_dataset("csr_indptr", data=indptr, compression="lzf")
+            data_grp.create_dataset("csr_indices", data=cols[order], compression="lzf")
+            edge_grp = data_grp.create_group("csr_data")
+            for prop in self._edges.columns:
+                edge_grp.create_dataset(prop, data=self._edges[prop].to_numpy()[order], compression="lzf")
+            data_grp.attrs["NEUROTOP_SHAPE"] = self._shape
+            data_grp.attrs["NEUROTOP_DEFAULT_EDGE"] = self._default_edge
+            data_grp.attrs["NEUROTOP_EDGE_PROPERTIES"] = list(self._edges.columns)
+            data_grp.attrs["NEUROTOP_CLASS"] = self.H5_CLASS
+            data_grp.attrs["ASSEMBLYFIRE_FORMAT_VERSION"] = self.H5_FORMAT_VERSION
+
+    @classmethod
+    def from_h5(cls, fn, group_name=None, prefix=None):
+        """Same as `ConnectivityMatrix.from_h5()` but reads the edges saved as CSR arrays by `to_h5()` above
+        (falls back to reading the pandas DataFrames saved by `ConnectivityMatrix.to_h5()`)"""
+        prefix = "connectivity" if prefix is None else prefix
+        group_name = "full_matrix" if group_name is None else group_name
+        full_prefix = prefix + "/" + group_name
+        with h5py.File(fn, "r") as h5:
+            data_grp = h5[full_prefix]
+            if data_grp.attrs.get("NEUROTOP_CLASS") != cls.H5_CLASS:
+                return super(AssemblyTopology, cls).from_h5(fn, group_name=group_name, prefix=prefix)
+            version = data_grp.attrs["ASSEMBLYFIRE_FORMAT_VERSION"]
+            if version > cls.H5_FORMAT_VERSION:
+                raise ValueError("%s was saved in format version %i, but only <= %i is supported"
+                                 % (full_prefix, version, cls.H5_FORMAT_VERSION))
+            shape = tuple(data_grp.attrs["NEUROTOP_SHAPE"])
+            def_edge = data_grp.attrs["NEUROTOP_DEFAULT_EDGE"]
+            indptr, indices = data_grp["csr_indptr"][:], data_grp["csr_indices"][:]
+            edges = pd.DataFrame({prop: data_grp["csr_data"][prop][:]
+                                  for prop in data_grp.attrs["NEUROTOP_EDGE_PROPERTIES"]})
+        vertex_properties = pd.read_hdf(fn, full_prefix + "/vertex_properties")
+        rows = np.repeat(np.arange(shape[0]), np.diff(indptr))
+        return cls(rows, indices, vertex_properties=vertex_properties, edge_properties=edges,
+                   default_edge_property=def_edge, shape=shape)
+
+    def array_(self, edge_property=None):
+        """Same as `ConnectivityMatrix.array_()` but densifies the sparse matrix directly into an array
+        (instead of to a `np.matrix` first and then copying that to an array)"""
+        warnings.warn("Dense (n x n) connectivity matrices are memory hungry... "
+                      "use `matrix_()` or `submatrix_sum()` instead", DeprecationWarning, stacklevel=2)
+        return self.matrix_(edge_property).toarray()
+
+    def dense_matrix_(self, edge_property=None):
+        """Same as `ConnectivityMatrix.dense_matrix_()` (but as a view of `array_()`)"""
+        return np.asmatrix(self.array_(edge_property))
+
+    def subarray(self, sub_gids, edge_property=None, sub_gids_post=None):
+        """Same as `ConnectivityMatrix.subarray()` but densifies the submatrix directly into an array"""
+        warnings.warn("Dense connectivity matrices are memory hungry... "
+                      "use `submatrix()` or `submatrix_sum()` instead", DeprecationWarning, stacklevel=2)
+        return self.submatrix(sub_gids, edge_property=edge_property, sub_gids_post=sub_gids_post).toarray()
+
+    def dense_submatrix(self, sub_gids, edge_property=None, sub_gids_post=None):
+        """Same as `ConnectivityMatrix.dense_submatrix()` (but as a view of `subarray()`)"""
+        return np.asmatrix(self.subarray(sub_gids, edge_property=edge_property, sub_gids_post=sub_gids_post))
+
+    def submatrix_sum(self, sub_gids=None, axis=0, edge_property=None, sub_gids_post=None):
+        """Returns the column (`axis=0`) or row (`axis=1`) sums of the submatrix specified by `sub_gids`
+        (and `sub_gids_post`) computed on the sparse (cached CSR) matrix, without densifying it"""
+        if sub_gids is None:
+            matrix = self.matrix_(edge_property, fmt="csr")
+        else:
+            matrix = self.submatrix(sub_gids, edge_property=edge_property, sub_gids_post=sub_gids_post)
+        return np.asarray(matrix.sum(axis=axis)).flatten()
 
     def degree(self, pre_gids=None, post_gids=None, kind="in"):
         """Returns in/out degrees of the (symmetric) subarray specified by `pre_gids`
         (if `post_gids` is given as well, then the subarray will be asymmetric)"""
-        if pre_gids is None:
-            matrix = self.matrix
-        else:
-            if post_gids is None:
-                matrix = self.submatrix(pre_gids)
-            else:
-                matrix = self.submatrix(pre_gids, sub_gids_post=post_gids)
         if kind == "in":
-            return np.array(matrix.sum(axis=0)).flatten()
+            return self.submatrix_sum(pre_gids, axis=0, sub_gids_post=post_gids)
         elif kind == "out":
-            return np.array(matrix.sum(axis=1)).flatten()
+            return self.submatrix_sum(pre_gids, axis=1, sub_gids_post=post_gids)
         else:
             ValueError("Need to specify 'in' or 'out' degree!")
 
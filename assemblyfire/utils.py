@@ -7,23 +7,44 @@ import os
 import json
 import h5py
 import warnings
-from collections import namedtuple
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import pandas as pd
 from libsonata import EdgeStorage
 from bluepysnap import Circuit, Simulation
 
-SpikeMatrixResult = namedtuple("SpikeMatrixResult", ["spike_matrix", "gids", "t_bins"])
+from assemblyfire.spikes import SpikeMatrixResult
+try:  # registers the HDF5 filters (e.g. bitshuffle) needed to read spike matrices saved with `hdf5plugin`
+    import hdf5plugin
+except ImportError:
+    pass
+try:  # only needed for parsing `out.dat` files for spike replay in BGLibPy (imported once, not at every call)
+    from bluepy.impl.spike_report import SpikeReport  # TODO: fix this
+except ImportError:
+    SpikeReport = None
 
 
-def get_bluepy_circuit(circuitconfig_path):
+@lru_cache(maxsize=8)
+def _get_bluepy_circuit(circuitconfig_path):
     return Circuit(circuitconfig_path)
 
 
-def get_bluepy_simulation(blueconfig_path):
+def get_bluepy_circuit(circuitconfig_path):
+    """Loads circuit (cached by absolute path, so don't modify the returned object)"""
+    return _get_bluepy_circuit(os.path.realpath(circuitconfig_path))
+
+
+@lru_cache(maxsize=8)
+def _get_bluepy_simulation(blueconfig_path):
     return Simulation(blueconfig_path)
 
 
+def get_bluepy_simulation(blueconfig_path):
+    """Loads simulation (cached by absolute path, so don't modify the returned object)"""
+    return _get_bluepy_simulation(os.path.realpath(blueconfig_path))
+
+
 def get_bglibpy_ssim(blueconfig_path):
     try:
         import bglibpy
@@ -36,8 +57,7 @@ def get_bglibpy_ssim(blueconfig_path):
 
 
 def ensure_dir(dirpath):
-    if not os.path.exists(dirpath):
-        os.makedirs(dirpath)
+    os.makedirs(dirpath, exist_ok=True)
 
 
 def get_sim_path(root_path):
@@ -50,24 +70,22 @@ def get_sim_path(root_path):
     return sim_paths
 
 
+@lru_cache(maxsize=8)
 def get_bluepy_circuit_from_root_path(root_path):
-    """Return bluepy circuit from the first simulation in the project root"""
+    """Return bluepy circuit from the first simulation in the project root
+    (cached, as it's called by several steps of the pipeline, so don't modify the returned object)"""
     return get_bluepy_simulation(get_sim_path(root_path).iloc[0]).circuit
 
 
 def get_stimulus_stream(f_name, t_start=None, t_end=None):
     """Reads the series of presented patterns from .txt file"""
-    stim_times, patterns = [], []
-    with open(f_name, "r") as f:
-        for line in f:
-            tmp = line.strip().split()
-            stim_times.append(float(tmp[0]))
-            patterns.append(tmp[1])
-    stim_times, patterns = np.asarray(stim_times), np.asarray(patterns)
+    df = pd.read_csv(f_name, sep=r"\s+", header=None, usecols=[0, 1], names=["t", "pattern"],
+                     dtype={"t": np.float64, "pattern": str}, engine="c", memory_map=True)
+    stim_times, patterns = df["t"].to_numpy(), df["pattern"].to_numpy().astype(str)
     if t_start is None and t_end is None:  # TODO: handle them separately as well...
         return stim_times, patterns
     else:
-        idx = np.where((t_start < stim_times) & (stim_times < t_end))[0]
+        idx = (t_start < stim_times) & (stim_times < t_end)
         return stim_times[idx], patterns[idx]
 
 
@@ -78,12 +96,20 @@ def get_pattern_node_idx(jf_name):
     return {pattern_name: np.array(tmp["node_id"]) for pattern_name, tmp in node_idx.items()}
 
 
+@lru_cache(maxsize=1)
+def _load_fiber_locations(locf_name):
+    """Loads (and caches) the gids and locations of the input fibers from .txt file
+    (with pandas' C parser, which is much faster than `np.loadtxt()` for big files)"""
+    tmp = pd.read_csv(locf_name, sep=r"\s+", header=None, comment="#", engine="c", dtype=np.float64,
+                      memory_map=True).to_numpy()
+    return tmp[:, 0].astype(int), tmp[:, 1:]
+
+
 def get_pattern_distance(locf_name, jf_name):
     """Gets Earth mover's distance of the input pattern fibers"""
     from scipy.spatial.distance import cdist
     from scipy.optimize import linear_sum_assignment
-    tmp = np.loadtxt(locf_name)
-    gids, pos = tmp[:, 0].astype(int), tmp[:, 1:]
+    gids, pos = _load_fiber_locations(locf_name)
     pattern_gids = get_pattern_node_idx(jf_name)
     pattern_pos = {pattern_name: pos[np.in1d(gids, gids_, assume_unique=True), :]
                    for pattern_name, gids_ in pattern_gids.items()}
@@ -135,7 +161,8 @@ def get_spikes(sim, node_pop, gids, t_start, t_end):
         spikes = sim.spikes[node_pop].get(t_start=t_start, t_stop=t_end)
     else:
         spikes = sim.spikes[node_pop].get(gids, t_start=t_start, t_stop=t_end)
-    return spikes.index.to_numpy(), spikes.to_numpy()
+    # (explicit dtypes, so that no copies are made if bluepy already returns them like this)
+    return spikes.index.to_numpy(dtype=np.float64, copy=False), spikes.to_numpy(dtype=np.int64, copy=False)
 
 
 def get_proj_edge_pops(circuit_config, local_edge_pop):
@@ -158,23 +185,50 @@ def _get_spikef_names(sim_config):
     return spikef_names
 
 
+def _load_replay_spikes(f_name):
+    """Loads replay spikes from SpikeFile as a (time sorted) structured array.
+    The parsed file is cached as .npy next to the SpikeFile (and regenerated if the SpikeFile is newer),
+    and that is memory mapped, so later calls only read the pages needed (instead of parsing the whole text file)"""
+    npy_name = f_name + ".npy"
+    if not os.path.isfile(npy_name) or os.path.getmtime(npy_name) < os.path.getmtime(f_name):
+        # (pandas' C parser with explicit dtypes, see `_load_fiber_locations()` above)
+        tmp = pd.read_csv(f_name, sep=r"\s+", skiprows=1, header=None, names=["t", "gid"], engine="c",
+                          dtype={"t": np.float64, "gid": np.int64}, memory_map=True)
+        sort_idx = np.argsort(tmp["t"].to_numpy(), kind="stable")
+        spikes = np.empty(len(tmp), dtype=[("t", np.float64), ("gid", np.int64)])
+        spikes["t"], spikes["gid"] = tmp["t"].to_numpy()[sort_idx], tmp["gid"].to_numpy()[sort_idx]
+        tmp_name = "%s.%i.tmp" % (npy_name, os.getpid())
+        try:  # write to a temp. file first, so that a failed/concurrent write never leaves a broken cache behind
+            with open(tmp_name, "wb") as f:
+                np.save(f, spikes)
+            os.replace(tmp_name, npy_name)
+        except OSError:  # (e.g. no write permission next to the SpikeFile, or disk full)
+            if os.path.exists(tmp_name):  # don't leave a partially written file behind
+                os.remove(tmp_name)
+            return spikes
+    return np.load(npy_name, mmap_mode="r")
+
+
 def get_proj_spikes(sim_config, t_start, t_end):
     """Loads in input spikes (on projections) using the `bluepysnap.Simulation.config` object"""
     spikef_names = _get_spikef_names(sim_config)
     spikes = {}
     for node_pop, f_name in spikef_names.items():
-        tmp = np.loadtxt(f_name, skiprows=1)
-        spike_times, spiking_gids = tmp[:, 0], tmp[:, 1].astype(int)
-        idx = np.where((t_start < spike_times) & (spike_times < t_end))[0]
+        replay_spikes = _load_replay_spikes(f_name)
+        # spikes are sorted in time, so the window is found by binary search
+        start = np.searchsorted(replay_spikes["t"], t_start, side="right")
+        end = np.searchsorted(replay_spikes["t"], t_end, side="left")
+        spike_times, spiking_gids = np.array(replay_spikes["t"][start:end]), np.array(replay_spikes["gid"][start:end])
         # -1 because spike replay still has an offset in `py-neurodamus`... get rid of it once that's fixed
-        spikes[node_pop] = {"spike_times": spike_times[idx], "spiking_gids": spiking_gids[idx] - 1}
+        spikes[node_pop] = {"spike_times": spike_times, "spiking_gids": spiking_gids - 1}
     return spikes
 
 
 # copy-pasted from bglibpy/ssim.py (until BGLibPy will support adding spikes from SpikeFile!)
 def _parse_outdat(f_name):
     """Parse the replay spiketrains in a out.dat formatted file"""
-    from bluepy.impl.spike_report import SpikeReport  # TODO: fix this
+    if SpikeReport is None:
+        raise ImportError("Parsing `out.dat` files requires `bluepy`")
     spikes = SpikeReport.load(f_name).get()
     # convert Series to DataFrame with 2 columns for `groupby` operation
     spike_df = spikes.to_frame().reset_index()
@@ -195,21 +249,42 @@ def get_tc_spikes_bglibpy(sim_config):  # TODO: test this!
     return spikes
 
 
+def _init_pattern_matrices(t_bins, stim_times, patterns):
+    """Initializes empty (NaN) matrices (repetitions x time bins) for every pattern
+    (stacked into a single array: patterns x repetitions x time bins)"""
+    pattern_names, counts = np.unique(patterns, return_counts=True)
+    isi, bin_size = np.max(np.diff(stim_times)), np.min(np.diff(t_bins))
+    pattern_matrices = np.full((len(pattern_names), np.max(counts), int(np.ceil(isi / bin_size))), np.nan)
+    return pattern_names, pattern_matrices, bin_size
+
+
+def _fill_pattern_matrices(pattern_matrices, pattern_names, clusters, t_bins, stim_times, patterns, bin_size):
+    """Fills (preallocated, see above) `pattern_matrices` in place with clustered sign. activity
+    (instead of looping over stimuli, the stimulus, and thus the pattern, repetition, and time offset of every
+    time bin is found by a single binary search (both `t_bins` and `stim_times` are sorted) and written in one go)"""
+    n_stims = min(len(patterns), len(stim_times) - 1)
+    pattern_idx = np.searchsorted(pattern_names, np.asarray(patterns)[:n_stims])
+    # repetition (row) of every stimulus: its rank among the presentations of the same pattern
+    sort_idx = np.argsort(pattern_idx, kind="stable")
+    first_idx = np.searchsorted(pattern_idx[sort_idx], pattern_idx[sort_idx])
+    rows = np.empty(n_stims, dtype=int)
+    rows[sort_idx] = np.arange(n_stims) - first_idx
+    stim_idx = np.searchsorted(stim_times, t_bins, side="right") - 1
+    mask = (0 <= stim_idx) & (stim_idx < n_stims)
+    stim_idx = stim_idx[mask]
+    t_idx = ((t_bins[mask] - stim_times[stim_idx]) / bin_size).astype(int)
+    pattern_matrices[pattern_idx[stim_idx], rows[stim_idx], t_idx] = clusters[mask]
+    n_rows = np.bincount(pattern_idx, minlength=len(pattern_names))
+    return {pattern: int(n) for pattern, n in zip(pattern_names, n_rows)}
+
+
 def group_clusters_by_patterns(clusters, t_bins, stim_times, patterns):
     """Groups clustered sign. activity based on the patterns presented"""
     # get basic info (passing them would be difficult...) and initialize empty matrices
-    pattern_names, counts = np.unique(patterns, return_counts=True)
-    isi, bin_size = np.max(np.diff(stim_times)), np.min(np.diff(t_bins))
-    pattern_matrices = {pattern: np.full((np.max(counts), int(np.ceil(isi / bin_size))), np.nan)
-                        for pattern in pattern_names}
+    pattern_names, pattern_matrices, bin_size = _init_pattern_matrices(t_bins, stim_times, patterns)
     # group sign. activity clusters based on patterns
-    row_idx = {pattern: 0 for pattern in pattern_names}
-    for pattern, t_start, t_end in zip(patterns, stim_times[:-1], stim_times[1:]):
-        idx = np.where((t_start <= t_bins) & (t_bins < t_end))[0]
-        if len(idx):
-            t_idx = ((t_bins[idx] - t_start) / bin_size).astype(int)
-            pattern_matrices[pattern][row_idx[pattern], t_idx] = clusters[idx]
-        row_idx[pattern] += 1
+    row_idx = _fill_pattern_matrices(pattern_matrices, pattern_names, clusters, t_bins, stim_times, patterns, bin_size)
+    pattern_matrices = dict(zip(pattern_names, pattern_matrices))
     # find max length of sign. activity and cut all matrices there
     max_tidx = np.max([np.nonzero(~np.all(np.isnan(pattern_matrix), axis=0))[0][-1]
                        for _, pattern_matrix in pattern_matrices.items()]) + 1
@@ -219,26 +294,38 @@ def group_clusters_by_patterns(clusters, t_bins, stim_times, patterns):
     pattern_counts, n_clusters = {}, len(np.unique(clusters))
     for pattern_name, matrix in pattern_matrices.items():
         cluster_idx, cluster_counts = np.unique(matrix[~np.isnan(matrix)], return_counts=True)
+        cluster_idx = cluster_idx.astype(int)
+        mask = (0 <= cluster_idx) & (cluster_idx < n_clusters)
         counts = np.zeros(n_clusters, dtype=int)
-        for i in range(n_clusters):
-            if i in cluster_idx:
-                counts[i] = cluster_counts[cluster_idx == i]
+        counts[cluster_idx[mask]] = cluster_counts[mask]
         pattern_counts[pattern_name] = counts
     return bin_size * max_tidx, row_idx, pattern_matrices, pattern_counts
 
 
 def count_clusters_by_patterns_across_seeds(all_clusters, t_bins, stim_times, patterns, n_clusters):
     """Counts consensus assemblies across seeds based on the patterns presented"""
-    count_matrices = {pattern: np.zeros((len(all_clusters), n_clusters+1), dtype=int) for pattern in np.unique(patterns)}
-    seeds = []
+    # counts of all seeds and patterns are stored in a single (seeds x patterns x consensus assemblies) array
+    pattern_names = np.unique(patterns)
+    count_matrices = np.zeros((len(all_clusters), len(pattern_names), n_clusters + 1), dtype=int)
+    # pattern matrices are allocated once, and only reset for every seed
+    # (only the clusters are counted, thus the matrices don't have to be cut as in `group_clusters_by_patterns()`)
+    seeds, pattern_matrices, bin_size = [], None, None
     for i, (seed, clusters) in enumerate(all_clusters.items()):
         seeds.append(seed)
-        _, _, pattern_matrices, _ = group_clusters_by_patterns(clusters, t_bins[seed], stim_times, patterns)
-        for pattern, matrix in pattern_matrices.items():
-            cons_assembly_idx, counts = np.unique(matrix, return_counts=True)
-            mask = ~np.isnan(cons_assembly_idx)
-            for cons_assembly_id, count in zip(cons_assembly_idx[mask], counts[mask]):
-                count_matrices[pattern][i, int(cons_assembly_id+1)] = count
+        if bin_size != np.min(np.diff(t_bins[seed])):
+            pattern_names, pattern_matrices, bin_size = _init_pattern_matrices(t_bins[seed], stim_times, patterns)
+        else:
+            pattern_matrices.fill(np.nan)
+        _fill_pattern_matrices(pattern_matrices, pattern_names, clusters, t_bins[seed], stim_times, patterns, bin_size)
+        # count (pattern, consensus assembly) pairs of all patterns in one go (-1 is stored in the first column)
+        mask = ~np.isnan(pattern_matrices)
+        pattern_idx, cons_assembly_idx = np.nonzero(mask)[0], pattern_matrices[mask].astype(int) + 1
+        if len(cons_assembly_idx) and (cons_assembly_idx.min() < 0 or cons_assembly_idx.max() > n_clusters):
+            # (out of range ids would be silently counted in the neighbouring pattern's row otherwise)
+            raise IndexError("Consensus assembly ids of %s should be in [-1, %i]" % (seed, n_clusters - 1))
+        count_matrices[i] = np.bincount(pattern_idx * (n_clusters + 1) + cons_assembly_idx,
+                                        minlength=count_matrices[i].size).reshape(count_matrices[i].shape)
+    count_matrices = {pattern: count_matrices[:, j, :] for j, pattern in enumerate(pattern_names)}
     return count_matrices, seeds, np.array([-1] + [i for i in range(n_clusters)])
 
 
@@ -246,16 +333,43 @@ def load_pkl_df(pklf_name):
     return pd.read_pickle(pklf_name)
 
 
-def _il_isin(whom, where, parallel):
-    """Sirio's in line np.isin() using joblib as parallel backend"""
-    if parallel:
+def _sorted_isin(whom, sorted_where):
+    """np.isin() against an already sorted array (binary search + equality check, no sorting per call)"""
+    if not len(sorted_where):
+        return np.zeros(len(whom), dtype=bool)
+    idx = np.searchsorted(sorted_where, whom)
+    np.clip(idx, 0, len(sorted_where) - 1, out=idx)
+    return sorted_where[idx] == whom
+
+
+def _bitmap_isin(whom, where):
+    """np.isin() via a boolean lookup table over the range of `where` (no sorting, O(N+M))"""
+    offset = where.min()
+    bitmap = np.zeros(where.max() - offset + 1, dtype=bool)
+    bitmap[where - offset] = True
+    idx = whom - offset
+    mask = (0 <= idx) & (idx < len(bitmap))
+    flt = np.zeros(len(whom), dtype=bool)
+    flt[mask] = bitmap[idx[mask]]
+    return flt
+
+
+def _il_isin(whom, where, parallel, min_parallel_size=100000):
+    """Sirio's in line np.isin() using joblib as parallel backend
+    (`where` is sorted only once and shared by all threads, instead of being sorted for every chunk.
+    If the gids in `where` are dense (which they are in the usual node sets), a lookup table is used instead,
+    and for small `whom` arrays threads aren't started, as it'd take longer than the lookup itself)"""
+    if len(where) and where.max() - where.min() < 8 * len(where):
+        return _bitmap_isin(whom, where)
+    where = np.sort(where)
+    if parallel and len(whom) >= min_parallel_size:
         from joblib import Parallel, delayed
-        nproc = os.cpu_count() - 1
+        nproc = max(os.cpu_count() - 1, 1)
         with Parallel(n_jobs=nproc, prefer="threads") as p:
-            flt = p(delayed(np.isin)(chunk, where) for chunk in np.array_split(whom, nproc))
+            flt = p(delayed(_sorted_isin)(chunk, where) for chunk in np.array_split(whom, nproc))
         return np.concatenate(flt)
     else:
-        return np.isin(whom, where)
+        return _sorted_isin(whom, where)
 
 
 def get_syn_idx(edgef_name, pre_node_idx, post_node_idx, parallel=True):
@@ -317,7 +431,7 @@ def save_syn_clusters(save_dir_root, assembly_idx, cluster_df, cross_assembly=Fa
     else:
         pklf_name = os.path.join(save_dir, "cross_assembly%i.pkl" % (assembly_idx[0]))
     cluster_df.sort_index(inplace=True)
-    cluster_df.to_pickle(pklf_name)
+    cluster_df.to_pickle(pklf_name, protocol=5)
 
 
 def read_base_h5_metadata(h5f_name):
@@ -338,51 +452,115 @@ def _read_h5_metadata(h5f, group_name=None, prefix=None):
     return metadata
 
 
-def load_spikes_from_h5(h5f_name, prefix="spikes"):
-    """Load spike matrices over seeds from saved h5 file"""
-    h5f = h5py.File(h5f_name, "r")
-    seeds = list(h5f[prefix].keys())
-    project_metadata = _read_h5_metadata(h5f, prefix=prefix)
+def _read_h5_attr(h5f, key, group_name=None, prefix=None):
+    """Reads a single metadata entry from h5 attributes (without copying all of them, as `_read_h5_metadata()` does)
+    (the group's attribute takes precedence over the prefix's one, as in `_read_h5_metadata()`)"""
+    if prefix is None:
+        prefix = "assemblies"
     prefix_grp = h5f[prefix]
+    if group_name is not None:
+        assert group_name in prefix_grp
+        if key in prefix_grp[group_name].attrs:
+            return prefix_grp[group_name].attrs[key]
+    return prefix_grp.attrs[key]
+
+
+def _read_h5_dset(dset, dtype=None):
+    """Reads full HDF5 dataset directly into a preallocated array (without the temporary buffer of `dset[:]`)
+    if `dtype` is passed, HDF5 converts the data while reading (e.g. spike matrices stored as `uint8` to float64)"""
+    data = np.empty(dset.shape, dtype=dset.dtype if dtype is None else dtype)
+    if data.size:
+        dset.read_direct(data)
+    return data
+
+
+def _downcast_spike_matrix(spike_matrix):
+    """Stores (binned) spike counts as `uint8` if all of them fit into it (8x less disk space than float64)
+    only used when saving: the loaders return float64 (as the rest of the pipeline expects) via `_read_h5_dset()`
+    `t_bins` are not touched, as spike times (in ms) for long simulations would lose precision as float32"""
+    if spike_matrix.dtype == np.uint8 or not spike_matrix.size:
+        return spike_matrix
+    if spike_matrix.min() >= 0 and spike_matrix.max() < 256 and (np.issubdtype(spike_matrix.dtype, np.integer) or
+                                                                 np.array_equal(spike_matrix, np.floor(spike_matrix))):
+        return spike_matrix.astype(np.uint8)
+    return spike_matrix  # fallback for non-integer (e.g. averaged) matrices and bins with >255 spikes
+
+
+def _load_spikes_from_zarr(zarr_name, prefix="spikes"):
+    """Load spike matrices over seeds from a zarr store (with the same layout as the h5 file)
+    zarr decompresses chunks without holding the GIL, so seeds are read in parallel threads"""
+    try:
+        import zarr
+    except ImportError:
+        raise ImportError("Loading spike matrices from %s requires `zarr`" % zarr_name)
+    prefix_grp = zarr.open_group(zarr_name, mode="r")[prefix]
+    project_metadata = dict(prefix_grp.attrs)
+    seeds = list(prefix_grp.group_keys())
+    read_seed = lambda seed: [prefix_grp[seed][name][...] for name in ["spike_matrix", "gids", "t_bins"]]
+    with ThreadPoolExecutor(max_workers=max(1, min(len(seeds), os.cpu_count() - 1))) as ex:
+        spikes = ex.map(read_seed, seeds)
+        # (spike matrices might be stored as `uint8`, see `_downcast_spike_matrix()`, but are returned as float64)
+        spike_matrix_dict = {seed: SpikeMatrixResult(spike_matrix.astype(np.float64, copy=False), gids, t_bins)
+                             for seed, (spike_matrix, gids, t_bins) in zip(seeds, spikes)}
+    return spike_matrix_dict, project_metadata
+
+
+def load_spikes_from_h5(h5f_name, prefix="spikes"):
+    """Load spike matrices over seeds from saved h5 file (or from a zarr store, i.e. a .zarr directory)"""
+    if h5f_name.endswith(".zarr") or os.path.isdir(h5f_name):
+        return _load_spikes_from_zarr(h5f_name, prefix)
     spike_matrix_dict = {}
-    for seed in seeds:
-        spike_matrix_dict[seed] = SpikeMatrixResult(prefix_grp[seed]["spike_matrix"][:],
-                                                    prefix_grp[seed]["gids"][:],
-                                                    prefix_grp[seed]["t_bins"][:])
-    h5f.close()
+    # big chunk cache, as (compressed) spike matrices are read in full
+    with h5py.File(h5f_name, "r", rdcc_nbytes=256 * 1024 ** 2, rdcc_nslots=52069) as h5f:
+        project_metadata = _read_h5_metadata(h5f, prefix=prefix)
+        seeds = list(h5f[prefix].keys())
+        # (spike matrices might be stored as `uint8`, see `_downcast_spike_matrix()`, but are returned as float64)
+        read_seed = lambda seed: [_read_h5_dset(h5f[prefix][seed]["spike_matrix"], dtype=np.float64),
+                                  _read_h5_dset(h5f[prefix][seed]["gids"]), _read_h5_dset(h5f[prefix][seed]["t_bins"])]
+        # the next seed is read (in a background thread) while the current one is being processed
+        with ThreadPoolExecutor(max_workers=1) as ex:
+            future = ex.submit(read_seed, seeds[0]) if len(seeds) else None
+            for i, seed in enumerate(seeds):
+                spike_matrix, gids, t_bins = future.result()
+                if i + 1 < len(seeds):
+                    future = ex.submit(read_seed, seeds[i + 1])
+                spike_matrix_dict[seed] = SpikeMatrixResult(spike_matrix, gids, t_bins)
     return spike_matrix_dict, project_metadata
 
 
 def load_assemblies_from_h5(h5f_name, prefix="assemblies"):
     """Load assemblies over seeds from saved h5 file into dict of AssemblyGroups"""
     from assemblyfire.assemblies import AssemblyGroup
-    h5f = h5py.File(h5f_name, "r")
-    seeds = list(h5f[prefix].keys())
-    project_metadata = {seed: _read_h5_metadata(h5f, seed, prefix) for seed in seeds}
-    h5f.close()
-    assembly_grp_dict = {seed: AssemblyGroup.from_h5(h5f_name, seed, prefix=prefix) for seed in seeds}
+    # the file is opened only once, and the open file is passed to `from_h5()` for all seeds
+    with h5py.File(h5f_name, "r", rdcc_nbytes=128 * 1024 ** 2) as h5f:
+        seeds = list(h5f[prefix].keys())
+        project_metadata = {seed: _read_h5_metadata(h5f, seed, prefix) for seed in seeds}
+        assembly_grp_dict = {}
+        for seed in seeds:  # all groups share the same `all_neurons`: it's read only once (instead of once per seed)
+            all_neurons = assembly_grp_dict[seeds[0]].all if len(assembly_grp_dict) else None
+            assembly_grp_dict[seed] = AssemblyGroup.from_h5(h5f, seed, prefix=prefix, all_neurons=all_neurons)
     return assembly_grp_dict, project_metadata
 
 
 def assembly_groupdic2assembly_grp(assembly_grp_dict):
     from assemblyfire.assemblies import AssemblyGroup
     """Builds 1 big assembly group from assemblies in `assembly_grp_dict` for consensus clustering"""
-    gids, n_assemblies, assembly_lst = [], [], []
+    n_assemblies, assembly_lst = [], []
     for seed, assembly_grp in assembly_grp_dict.items():
-        gids.extend(assembly_grp.all.tolist())
         n = len(assembly_grp.assemblies)
         n_assemblies.append(n)
         assembly_lst.extend([assembly_grp.assemblies[i] for i in range(n)])
-    return AssemblyGroup(assembly_lst, np.unique(gids), label="all"), n_assemblies
+    gids = np.unique(np.concatenate([assembly_grp.all for assembly_grp in assembly_grp_dict.values()]))
+    return AssemblyGroup(assembly_lst, gids, label="all"), n_assemblies
 
 
 def load_consensus_assemblies_from_h5(h5f_name, prefix="consensus"):
     """Load consensus (clustered and thresholded )assemblies
     from saved h5 file into dict of ConsensusAssembly objects"""
     from assemblyfire.assemblies import ConsensusAssembly
-    with h5py.File(h5f_name, "r") as h5f:
-        keys = list(h5f[prefix].keys())
-    return {k: ConsensusAssembly.from_h5(h5f_name, k, prefix=prefix) for k in keys}
+    with h5py.File(h5f_name, "r", rdcc_nbytes=64 * 1024 ** 2) as h5f:
+        prefix_grp = h5f[prefix]  # group names are listed only once
+        return {k: ConsensusAssembly.from_h5(h5f, k, prefix=prefix) for k in list(prefix_grp)}
 
 
 def consensus_dict2assembly_grp(consensus_assemblies):
@@ -390,13 +568,13 @@ def consensus_dict2assembly_grp(consensus_assemblies):
     (AssemblyGroups are used by several functions investigating connectivity to iterate over assemblies...)"""
     from assemblyfire.assemblies import AssemblyGroup
     cons_assembly_idx = np.sort([int(key.split("cluster")[1]) for key in list(consensus_assemblies.keys())])
-    all_gids, assembly_lst = [], []
+    assembly_lst = []
     for cons_assembly_id in cons_assembly_idx:
         cons_assembly = consensus_assemblies["cluster%i" % cons_assembly_id]
-        all_gids.extend(cons_assembly.union.gids)
         cons_assembly.idx = (cons_assembly_id, "consensus")
         assembly_lst.append(cons_assembly)
-    return AssemblyGroup(assemblies=assembly_lst, all_gids=np.unique(all_gids), label="ConsensusGroup")
+    all_gids = np.unique(np.concatenate([cons_assembly.union.gids for cons_assembly in assembly_lst]))
+    return AssemblyGroup(assemblies=assembly_lst, all_gids=all_gids, label="ConsensusGroup")
 
 
 def load_syn_nnd_from_h5(h5f_name, n_assemblies, prefix):
@@ -416,22 +594,19 @@ def load_syn_nnd_from_h5(h5f_name, n_assemblies, prefix):
 
 def load_single_cell_features_from_h5(h5f_name, prefix="single_cell"):
     """Load spike matrices over seeds from saved h5 file"""
-    h5f = h5py.File(h5f_name, "r")
-    prefix_grp = h5f[prefix]
-    single_cell_features = {"gids": prefix_grp["gids"][:], "r_spikes": prefix_grp["r_spikes"][:]}
-    h5f.close()
+    with h5py.File(h5f_name, "r", rdcc_nbytes=256 * 1024 ** 2) as h5f:
+        prefix_grp = h5f[prefix]
+        single_cell_features = {name: _read_h5_dset(prefix_grp[name]) for name in ["gids", "r_spikes"]}
     return single_cell_features
 
 
 def read_cluster_seq_data(h5f_name):
     """Load metadata needed (stored under diff. prefixes) for re-plotting cluster (of time bin) sequences"""
-    h5f = h5py.File(h5f_name, "r")
-    spikes_metadata = _read_h5_metadata(h5f, prefix="spikes")
-    seeds = ["seed%i" % seed for seed in spikes_metadata["seeds"]]
-    assemblies_metadata = {seed: _read_h5_metadata(h5f, seed, "assemblies") for seed in seeds}
-    metadata = {"clusters": {seed: assemblies_metadata[seed]["clusters"] for seed in seeds},
-                "t_bins": {seed: h5f["spikes"][seed]["t_bins"][:] for seed in seeds},
-                "stim_times": spikes_metadata["stim_times"],
-                "patterns": spikes_metadata["patterns"]}
-    h5f.close()
+    with h5py.File(h5f_name, "r") as h5f:
+        spikes_metadata = _read_h5_metadata(h5f, prefix="spikes")
+        seeds = ["seed%i" % seed for seed in spikes_metadata["seeds"]]
+        metadata = {"clusters": {seed: _read_h5_attr(h5f, "clusters", seed, "assemblies") for seed in seeds},
+                    "t_bins": {seed: _read_h5_dset(h5f["spikes"][seed]["t_bins"]) for seed in seeds},
+                    "stim_times": spikes_metadata["stim_times"],
+                    "patterns": spikes_metadata["patterns"]}
     return metadata
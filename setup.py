@@ -47,7 +47,10 @@ setup(
     python_requires=">=3.8",
     entry_points={"console_scripts": ["assemblyfire=assemblyfire.cli:cli"]},
     extras_require={
-        "docs": ["sphinx", "sphinx-bluebrain-theme"]
+        "docs": ["sphinx", "sphinx-bluebrain-theme"],
+        "compression": ["hdf5plugin>=4.0.0"],
+        "zarr": ["zarr"],
+        "fastcluster": ["fastcluster>=1.2.6"]
     },
     classifiers=[
         "Development Status :: 2 - Pre-Alpha",
@@ -0,0 +1,25 @@
+import numpy
+import pytest
+from assemblyfire.utils import count_clusters_by_patterns_across_seeds
+
+t_bins = {"seed1": numpy.arange(0, 800, 20.)}
+stim_times = numpy.array([0., 200., 400., 600., 800.])
+patterns = ["A", "B", "A", "B"]
+
+
+def test_count_clusters_by_patterns_across_seeds():
+    all_clusters = {"seed1": numpy.array(([1] * 10 + [0] * 5 + [-1] * 5) * 2)}
+    count_matrices, seeds, cons_assembly_idx = count_clusters_by_patterns_across_seeds(all_clusters, t_bins,
+                                                                                       stim_times, patterns, 2)
+    assert seeds == ["seed1"]
+    assert numpy.array_equal(cons_assembly_idx, [-1, 0, 1])
+    # (10 bins per presentation: A -> 10 x id 1, B -> 5 x id 0 and 5 x id -1; both patterns presented twice)
+    assert numpy.array_equal(count_matrices["A"], [[0, 0, 20]])
+    assert numpy.array_equal(count_matrices["B"], [[10, 10, 0]])
+
+
+def test_count_clusters_by_patterns_across_seeds_out_of_range():
+    # id 3 with `n_clusters=2` used to be counted as cluster 0 of the next pattern
+    all_clusters = {"seed1": numpy.array(([3] * 10 + [0] * 10) * 2)}
+    with pytest.raises(IndexError):
+        count_clusters_by_patterns_across_seeds(all_clusters, t_bins, stim_times, patterns, 2)
@@ -0,0 +1,34 @@
+import os
+import numpy
+import pytest
+from assemblyfire import utils
+
+
+def _write_spikef(f_name):
+    with open(f_name, "w") as f:
+        f.write("/scatter\n")
+        for t, gid in [(30., 3), (10., 1), (20., 2), (40., 4)]:
+            f.write("%.1f\t%i\n" % (t, gid))
+
+
+def test_load_replay_spikes(tmp_path):
+    f_name = str(tmp_path / "input.dat")
+    _write_spikef(f_name)
+    for _ in range(2):  # first call parses the SpikeFile, second one loads the cached .npy
+        spikes = utils._load_replay_spikes(f_name)
+        assert numpy.array_equal(spikes["t"], [10., 20., 30., 40.])
+        assert numpy.array_equal(spikes["gid"], [1, 2, 3, 4])
+    assert sorted(os.listdir(tmp_path)) == ["input.dat", "input.dat.npy"]
+
+
+def test_load_replay_spikes_failed_cache(tmp_path, monkeypatch):
+    f_name = str(tmp_path / "input.dat")
+    _write_spikef(f_name)
+
+    def _failing_save(f, arr):  # write a few bytes before failing (as if the disk got full)
+        f.write(b"\x93NUMPY")
+        raise OSError("No space left on device")
+    monkeypatch.setattr(utils.np, "save", _failing_save)
+    spikes = utils._load_replay_spikes(f_name)
+    assert numpy.array_equal(spikes["gid"], [1, 2, 3, 4])
+    assert os.listdir(tmp_path) == ["input.dat"]  # no partially written temp. file (or cache) left behind
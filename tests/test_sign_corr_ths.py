@@ -0,0 +1,31 @@
+import numpy
+import pytest
+from assemblyfire.clustering import _convert_clusters, pairwise_correlation_xy, sign_corr_ths
+
+rng = numpy.random.default_rng(0)
+spike_matrix = (rng.random((40, 120)) < 0.1).astype(numpy.float64)
+spike_matrix[0] = 0.  # silent cell (constant row)
+clusters = rng.integers(-1, 4, spike_matrix.shape[1])
+nreps, batch_size = 130, 50  # (not a multiple of each other, to test the last, partial batch)
+
+
+def _reference_ths(clusters, th_pct):
+    """Correlations with all shuffles of the cluster columns (drawn in the same order as in `sign_corr_ths()`)
+    and their percentile calculated with `np.percentile()`"""
+    dense_clusters = clusters.toarray() if hasattr(clusters, "toarray") else clusters
+    n_bins = dense_clusters.shape[1]
+    corrs = numpy.stack([pairwise_correlation_xy(spike_matrix, dense_clusters[:, numpy.random.permutation(n_bins)])
+                         for _ in range(nreps)], axis=2)
+    return numpy.percentile(corrs, th_pct, axis=2)
+
+
+@pytest.mark.parametrize("sparse", [True, False])
+@pytest.mark.parametrize("th_pct", [0, 5, 50, 95, 100])
+def test_sign_corr_ths(th_pct, sparse):
+    one_hot_clusters = _convert_clusters(clusters)
+    if not sparse:
+        one_hot_clusters = one_hot_clusters.toarray()
+    numpy.random.seed(12)
+    corr_ths = sign_corr_ths(spike_matrix, one_hot_clusters, th_pct, nreps=nreps, batch_size=batch_size)
+    numpy.random.seed(12)
+    assert numpy.allclose(corr_ths, _reference_ths(one_hot_clusters, th_pct))
@@ -0,0 +1,61 @@
+import h5py
+import numpy
+import pandas
+import pytest
+from scipy import sparse
+from conntility.connectivity import ConnectivityMatrix
+from assemblyfire.topology import AssemblyTopology
+
+n = 100
+gids = numpy.arange(1000, 1000 + n)
+m = sparse.random(n, n, density=0.1, random_state=1, format="coo")
+edge_indices = pandas.DataFrame({"row": m.row, "col": m.col})
+edges = pandas.DataFrame({"data": numpy.ones(m.nnz, dtype=bool), "weight": m.data})
+vertex_properties = pandas.DataFrame({"depth": numpy.linspace(0., 1., n)}, index=pandas.Index(gids, name="gid"))
+sub_gids = gids[::3]
+
+
+def _conn_mat(cls):
+    return cls(edge_indices.copy(), vertex_properties=vertex_properties.copy(), edge_properties=edges.copy(),
+               shape=(n, n))
+
+
+def test_csr_roundtrip(tmp_path):
+    fn = str(tmp_path / "test_topology_io.h5")
+    conn_mat = _conn_mat(AssemblyTopology)
+    conn_mat.to_h5(fn)
+    with h5py.File(fn, "r") as h5:
+        assert h5["connectivity/full_matrix"].attrs["NEUROTOP_CLASS"] == AssemblyTopology.H5_CLASS
+        assert "csr_indptr" in h5["connectivity/full_matrix"]
+    conn_mat_read = AssemblyTopology.from_h5(fn)
+    assert numpy.array_equal(conn_mat_read.gids, gids)
+    pandas.testing.assert_frame_equal(conn_mat_read.vertices, conn_mat.vertices)
+    for prop in ["data", "weight"]:
+        assert numpy.array_equal(conn_mat_read.matrix_(prop).toarray(), conn_mat.matrix_(prop).toarray())
+    # submatrix and subpopulation of the reloaded object (against conntility's implementation on the original)
+    reference = _conn_mat(ConnectivityMatrix)
+    assert numpy.array_equal(conn_mat_read.submatrix(sub_gids, edge_property="weight").toarray(),
+                             reference.submatrix(sub_gids, edge_property="weight").toarray())
+    subpop, subpop_ref = conn_mat_read.subpopulation(sub_gids), reference.subpopulation(sub_gids)
+    assert numpy.array_equal(subpop.gids, subpop_ref.gids)
+    assert numpy.array_equal(subpop.matrix_("weight").toarray(), subpop_ref.matrix_("weight").toarray())
+    assert subpop._edges.index.equals(subpop._edge_indices.index)
+
+
+def test_read_conntility_h5(tmp_path):
+    fn = str(tmp_path / "test_topology_io.h5")
+    reference = _conn_mat(ConnectivityMatrix)
+    reference.to_h5(fn)
+    conn_mat_read = AssemblyTopology.from_h5(fn)
+    assert isinstance(conn_mat_read, AssemblyTopology)
+    for prop in ["data", "weight"]:
+        assert numpy.array_equal(conn_mat_read.matrix_(prop).toarray(), reference.matrix_(prop).toarray())
+
+
+def test_unknown_format_version(tmp_path):
+    fn = str(tmp_path / "test_topology_io.h5")
+    _conn_mat(AssemblyTopology).to_h5(fn)
+    with h5py.File(fn, "a") as h5:
+        h5["connectivity/full_matrix"].attrs["ASSEMBLYFIRE_FORMAT_VERSION"] = AssemblyTopology.H5_FORMAT_VERSION + 1
+    with pytest.raises(ValueError):
+        AssemblyTopology.from_h5(fn)